@@ -1 +1,11 @@
-from .manager import ReservoirManager, ElectricityManager, EarthquakeManager
+# The managers pull in requests and numpy, load them on first use so the web
+# workers, which only need api.models and api.database, never import them
+MANAGERS = ("ReservoirManager", "ElectricityManager", "EarthquakeManager")
+
+
+def __getattr__(name):
+    if name in MANAGERS:
+        from . import manager
+
+        return getattr(manager, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,42 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import argparse
+import asyncio
+import logging
 import os
-import time
-import threading
+import signal
 import sys
+import time
 
 sys.path.append(Path(__file__).resolve().parent.parent.__str__())
 os.environ["USE_WRITE_DB"] = "True"
 
-from api.database import init_db, session_maker_modify
-from api.models import Reservoir, Electricity, Earthquake
+from api.database import engine, init_db, session_maker_modify
+from api.leader import LeaderLease
+from api.models import (
+    Reservoir,
+    ReservoirReading,
+    Electricity,
+    Earthquake,
+    FetchState,
+    LatestReservoir,
+    LatestElectricity,
+    Lease,
+)
 from api.manager import ReservoirManager, ElectricityManager, EarthquakeManager
+from api.metrics import errors_total, start_metrics_server
+from api.retention import maintain_storage
+from api.scheduler import PollSchedule
+from api.startup import profile_startup
+
+# Threads blocked on upstream sockets, and threads parsing and writing to the DB
+FETCH_WORKERS = 8
+PROCESS_WORKERS = 2
+
+# Leases expire after half a cycle and are renewed three times per lease, so
+# a standby takes a resource over well within one update cycle
+LEASE_TTL_RATIO = 0.5
+LEASE_RENEWALS = 3
+
+# Partitions are created and expired months archived once a day
+MAINTENANCE_CYCLE = 60 * 60 * 24
+
+# Port of the fetcher's Prometheus endpoint
+METRICS_PORT = int(os.environ.get("FETCHER_METRICS_PORT", 9101))
+
+
+async def update(data, schedule, io_executor, work_executor):
+    loop = asyncio.get_running_loop()
+    lease = data.lease
+    # The constructor already fetched once
+    next_update = loop.time() + (
+        schedule.record(time.time(), timestamp(data.published_time), data.failed)
+        - time.time()
+    )
+
+    while True:
+        if lease is not None:
+            was_leader = lease.held
+            try:
+                await loop.run_in_executor(work_executor, lease.acquire)
+            except Exception:
+                logging.exception(f"Failed to renew the {lease.resource} lease")
+
+            if not lease.held:
+                await asyncio.sleep(lease.ttl / LEASE_RENEWALS)
+                continue
+            if not was_leader:
+                # Taking over from a failed replica, catch up immediately
+                next_update = loop.time()
 
+        if loop.time() >= next_update:
+            failed = True
+            try:
+                await data.update_async(loop, io_executor, work_executor)
+                failed = data.failed
+            except asyncio.TimeoutError:
+                errors_total.labels(data.name, "timeout").inc()
+                logging.error(
+                    f"Timeout after {data.fetch_timeout}s when fetching "
+                    f"{data.__class__.__name__} sources"
+                )
+            except Exception:
+                logging.exception(f"Failed to update {data.__class__.__name__}")
+            # Deadlines are absolute, the time spent updating does not add up
+            next_update = loop.time() + (
+                schedule.record(time.time(), timestamp(data.published_time), failed)
+                - time.time()
+            )
 
-def update(data, update_cycle):
-    global run
-    while run:
-        time.sleep(update_cycle)
-        data.update()
+        wait = next_update - loop.time()
+        if lease is not None:
+            wait = min(wait, lease.ttl / LEASE_RENEWALS)
+        await asyncio.sleep(max(wait, 0))
+
+
+async def maintain(lease, work_executor):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if await loop.run_in_executor(work_executor, lease.acquire):
+                await loop.run_in_executor(work_executor, maintain_storage, engine)
+        except Exception:
+            logging.exception("Failed to maintain the partitions and archives")
+        await asyncio.sleep(MAINTENANCE_CYCLE)
+
+
+async def main(data_manager, maintenance_lease):
+    # docker stop sends SIGTERM, which cancels the fetcher like Ctrl+C does so
+    # the leases are still released on the way out
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
+    with ThreadPoolExecutor(
+        max_workers=FETCH_WORKERS, thread_name_prefix="fetch"
+    ) as io_executor, ThreadPoolExecutor(
+        max_workers=PROCESS_WORKERS, thread_name_prefix="process"
+    ) as work_executor:
+        await asyncio.gather(
+            *(
+                update(*data, io_executor, work_executor)
+                for data in data_manager.values()
+            ),
+            maintain(maintenance_lease, work_executor),
+        )
+
+
+def timestamp(published_time):
+    return None if published_time is None else published_time.timestamp()
+
+
+def create_lease(resource, update_cycle):
+    return LeaderLease(
+        session_maker_modify, Lease, resource, update_cycle * LEASE_TTL_RATIO
+    )
 
 
 if __name__ == "__main__":
-    run = True
+    parser = argparse.ArgumentParser(description="Fetch the upstream data")
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print where the import time of the fetcher goes and exit",
+    )
+    if parser.parse_args().profile_startup:
+        sys.exit(profile_startup("import api.data_collect"))
 
     # Create database session
     init_db()
+    start_metrics_server(METRICS_PORT)
+    # Nominal interval until the cadence of the source is known, then polls
+    # between the min and max intervals around the expected publish times
     data_manager = {
-        "reservoir": [ReservoirManager(session_maker_modify, Reservoir), 60 * 60],
-        "electricity": [ElectricityManager(session_maker_modify, Electricity), 60 * 10],
-        "earthquake": [EarthquakeManager(session_maker_modify, Earthquake), 60 * 5],
+        "reservoir": [
+            ReservoirManager(
+                session_maker_modify,
+                Reservoir,
+                create_lease("reservoir", 60 * 60),
+                LatestReservoir,
+                ReservoirReading,
+            ),
+            PollSchedule(60 * 60, 60 * 5, 60 * 60 * 2),
+        ],
+        "electricity": [
+            ElectricityManager(
+                session_maker_modify,
+                Electricity,
+                create_lease("electricity", 60 * 10),
+                LatestElectricity,
+            ),
+            PollSchedule(60 * 10, 60, 60 * 30),
+        ],
+        "earthquake": [
+            EarthquakeManager(
+                session_maker_modify,
+                Earthquake,
+                create_lease("earthquake", 60 * 5),
+                FetchState,
+            ),
+            PollSchedule(60 * 5, 60, 60 * 15),
+        ],
     }
 
-    thread_manager = [
-        threading.Thread(target=update, args=(*data,), daemon=True)
-        for data in data_manager.values()
-    ]
-
-    for thread in thread_manager:
-        thread.start()
+    maintenance_lease = create_lease("maintenance", MAINTENANCE_CYCLE)
 
-    for thread in thread_manager:
-        thread.join()
+    try:
+        asyncio.run(main(data_manager, maintenance_lease))
+    except asyncio.CancelledError:
+        logging.info("Stopped by SIGTERM")
+    finally:
+        # Hand the resources over right away instead of waiting for expiry
+        for data, _ in data_manager.values():
+            data.lease.release()
+        maintenance_lease.release()
@@ -1,32 +1,158 @@
 import os
+import random
+import time
 from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 import dotenv
 import logging
 
 
 dotenv.load_dotenv(".env")
 
-if os.environ.get("USE_WRITE_DB") is not None:
+# Pool of every engine, per process. The defaults fit a gunicorn worker with
+# 4 threads, each holding at most one connection per request.
+POOL_OPTIONS = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", 4)),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 4)),
+    "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "True") == "True",
+}
+# Logging every statement is only useful when debugging
+DB_ECHO = os.environ.get("DB_ECHO", "False") == "True"
+
+pool_checkout_seconds = Histogram(
+    "db_pool_checkout_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["engine"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+pool_overflow_total = Counter(
+    "db_pool_overflow_total",
+    "Connections opened beyond pool_size",
+    ["engine"],
+)
+pool_timeout_total = Counter(
+    "db_pool_timeout_total",
+    "Checkouts that gave up after pool_timeout",
+    ["engine"],
+)
+pool_checked_out = Gauge(
+    "db_pool_checked_out", "Connections currently in use", ["engine"]
+)
+pool_size = Gauge("db_pool_size", "Connections kept open by the pool", ["engine"])
+
+
+class InstrumentedQueuePool(QueuePool):
+    # Subclassed per engine with engine_name set, recreate() keeps the class
+    engine_name = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            pool_timeout_total.labels(self.engine_name).inc()
+            raise
+        finally:
+            pool_checkout_seconds.labels(self.engine_name).observe(
+                time.perf_counter() - started
+            )
+
+    def _inc_overflow(self):
+        if super()._inc_overflow():
+            if self._overflow > 0:
+                pool_overflow_total.labels(self.engine_name).inc()
+            return True
+        return False
+
+
+def make_engine(url, engine_name):
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory SQLite lives in a single connection, there is no pool
+        return create_engine(url, echo=DB_ECHO)
+
     engine = create_engine(
-        f"mysql+pymysql://{os.getenv('MYSQL_WRITE_NAME')}:{os.getenv('MYSQL_WRITE_PASSWORD')}@{os.getenv('MYSQL_DB_HOST')}:{os.getenv('MYSQL_PORT')}/{os.getenv('MYSQL_DATABASE')}",
-        echo=True,
+        url,
+        echo=DB_ECHO,
+        poolclass=type(
+            "InstrumentedQueuePool",
+            (InstrumentedQueuePool,),
+            {"engine_name": engine_name},
+        ),
+        **POOL_OPTIONS,
     )
+    pool_checked_out.labels(engine_name).set_function(lambda: engine.pool.checkedout())
+    pool_size.labels(engine_name).set_function(lambda: engine.pool.size())
+    return engine
+
+
+def mysql_url(user, password, host):
+    return f"mysql+pymysql://{user}:{password}@{host}:{os.getenv('MYSQL_PORT')}/{os.getenv('MYSQL_DATABASE')}"
+
+
+if os.environ.get("DATABASE_URL"):
+    # Used by the CI and local tests to point both roles at a SQLite file
+    write_engine = make_engine(os.environ["DATABASE_URL"], "write")
+    read_engines = [write_engine]
 else:
-    engine = create_engine(
-        f"mysql+pymysql://{os.getenv('MYSQL_READ_USER')}:{os.getenv('MYSQL_READ_PASSWORD')}@{os.getenv('MYSQL_DB_HOST')}:{os.getenv('MYSQL_PORT')}/{os.getenv('MYSQL_DATABASE')}",
-        echo=True,
+    write_engine = make_engine(
+        mysql_url(
+            os.getenv("MYSQL_WRITE_NAME"),
+            os.getenv("MYSQL_WRITE_PASSWORD"),
+            os.getenv("MYSQL_DB_HOST"),
+        ),
+        "write",
     )
+    if os.environ.get("USE_WRITE_DB") is not None:
+        # The fetcher reads what it is about to write, replicas may lag behind
+        read_engines = [write_engine]
+    else:
+        # Comma separated replicas, the primary when there are none
+        read_hosts = os.environ.get("MYSQL_READ_HOSTS", os.getenv("MYSQL_DB_HOST"))
+        read_engines = [
+            make_engine(
+                mysql_url(
+                    os.getenv("MYSQL_READ_USER"), os.getenv("MYSQL_READ_PASSWORD"), host
+                ),
+                f"read-{i}",
+            )
+            for i, host in enumerate(read_hosts.split(","))
+        ]
+engine = write_engine
+
+
+class RoutingSession(Session):
+    # Sessions opened by session_maker_modify and every flush use the write
+    # engine, the others the read engine picked by session_maker_readonly
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get("write") or self._flushing or getattr(clause, "is_dml", False):
+            return write_engine
+        return self.info.get("read_engine", read_engines[0])
+
+
+def dispose_engines(close=True):
+    for routed_engine in {write_engine, *read_engines}:
+        routed_engine.dispose(close=close)
+
 
-DBSession = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+DBSession = scoped_session(
+    sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False)
+)
 
 Base = declarative_base()
 
 
 @contextmanager
 def session_maker_modify(session=DBSession):
+    session.info["write"] = True
     try:
         yield session
         session.commit()
@@ -36,10 +162,13 @@ def session_maker_modify(session=DBSession):
         raise
     finally:
         session.close()
+        session.info.pop("write", None)
 
 
 @contextmanager
 def session_maker_readonly(session=DBSession):
+    # One replica for the whole session, its reads see a single snapshot
+    session.info["read_engine"] = random.choice(read_engines)
     try:
         yield session
     except Exception as e:
@@ -47,6 +176,7 @@ def session_maker_readonly(session=DBSession):
         raise
     finally:
         session.close()
+        session.info.pop("read_engine", None)
 
 
 def init_db():
@@ -55,5 +185,7 @@ def init_db():
 
     sys.path.append(Path(__file__).resolve().parent.parent.__str__())
     import api.models
+    from api.migrate import migrate_schema
 
     Base.metadata.create_all(bind=engine)
+    migrate_schema(engine)
@@ -0,0 +1,342 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+import argparse
+import heapq
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+os.environ["USE_WRITE_DB"] = "True"
+
+from sqlalchemy import delete, desc, insert
+
+from api.database import engine, init_db, session_maker_modify
+from api.manager import SiteGrid, compute_impacts, sum_readings
+from api.models import (
+    Reservoir,
+    ReservoirReading,
+    Electricity,
+    Earthquake,
+    FetchState,
+    LatestReservoir,
+    LatestElectricity,
+)
+from api.regions import get_regions
+from api.rollup import rebuild_rollups
+
+# Real cadences of the upstream sources
+RESERVOIR_INTERVAL = timedelta(hours=1)
+ELECTRICITY_INTERVAL = timedelta(minutes=10)
+EARTHQUAKES_PER_DAY = 4.0
+
+# Bounds of the epicenters around Taiwan
+EPICENTER_LATITUDE = (21.8, 25.4)
+EPICENTER_LONGITUDE = (119.8, 122.4)
+
+
+def time_range(start_time, end_time, interval):
+    current_time = start_time
+    while current_time <= end_time:
+        yield current_time
+        current_time += interval
+
+
+def seasonal(current_time, peak_day=200):
+    # 1 at the peak of the year, -1 half a year later
+    return math.cos(2 * math.pi * (current_time.timetuple().tm_yday - peak_day) / 365)
+
+
+def generate_reservoir(start_time, end_time, interval, rng):
+    # Readings of every reservoir, then the county totals summed from them
+    # like the fetcher does, as (model, row) pairs
+    regions = get_regions()
+    ids = list(regions.id_to_area)
+    total_capacity = {id_: rng.uniform(500, 30000) for id_ in ids}
+    percentage = {id_: rng.uniform(0.4, 0.8) for id_ in ids}
+
+    for current_time in time_range(start_time, end_time, interval):
+        readings = {}
+        for id_ in ids:
+            # Storage fills in the plum rain and typhoon season and drains after
+            inflow = max(0.0, rng.gauss(10 + 8 * seasonal(current_time), 3))
+            outflow = max(0.0, rng.gauss(10, 2))
+            percentage[id_] += (inflow - outflow) / total_capacity[id_] / 10
+            percentage[id_] = min(1.0, max(0.05, percentage[id_]))
+            readings[id_] = {
+                "reservoir_id": id_,
+                "inflow": inflow,
+                "outflow": outflow,
+                "total_capacity": total_capacity[id_],
+                "current_capacity": total_capacity[id_] * percentage[id_],
+                "percentage": percentage[id_],
+                "observed_time": current_time,
+            }
+            yield ReservoirReading, readings[id_]
+
+        for area in regions.reservoir_areas:
+            yield Reservoir, {
+                "area": area,
+                **sum_readings([readings[id_] for id_ in regions.area_to_ids[area]]),
+            }
+
+
+def generate_electricity(start_time, end_time, interval, rng):
+    regions = {"north": 1.3, "central": 1.0, "south": 1.1}
+
+    for current_time in time_range(start_time, end_time, interval):
+        # Load peaks in the afternoon and in summer
+        hour = current_time.hour + current_time.minute / 60
+        daily = math.sin(2 * math.pi * (hour - 8) / 24)
+        row = {"updated_time": current_time}
+        for region, scale in regions.items():
+            usage = scale * (1000 + 250 * daily + 150 * seasonal(current_time))
+            row[f"{region}_usage"] = max(0.0, usage + rng.gauss(0, 20))
+            row[f"{region}_generate"] = max(0.0, usage * rng.uniform(0.8, 1.2))
+        yield row
+
+
+def generate_events(start_time, end_time, events_per_day, rng):
+    # Poisson background seismicity, larger shocks trigger aftershock bursts
+    queue = []
+    current_time = start_time
+    while True:
+        current_time += timedelta(days=rng.expovariate(events_per_day))
+        if current_time > end_time:
+            break
+        heapq.heappush(queue, (current_time, rng.random(), None))
+
+    numbers = {}
+    last_time = None
+    while queue:
+        event_time, _, main_shock = heapq.heappop(queue)
+        # Gutenberg-Richter magnitudes with b = 1 above magnitude 2
+        magnitude = min(7.5, 2.0 + rng.expovariate(math.log(10)))
+        if main_shock is None:
+            latitude = rng.uniform(*EPICENTER_LATITUDE)
+            longitude = rng.uniform(*EPICENTER_LONGITUDE)
+        else:
+            magnitude = min(magnitude, main_shock[2] - 0.5)
+            latitude = main_shock[0] + rng.gauss(0, 0.05)
+            longitude = main_shock[1] + rng.gauss(0, 0.05)
+
+        if main_shock is None and magnitude >= 5:
+            for _ in range(min(50, int(10 ** (magnitude - 4.5)))):
+                aftershock_time = event_time + timedelta(days=rng.expovariate(1 / 3))
+                if aftershock_time <= end_time:
+                    heapq.heappush(
+                        queue,
+                        (
+                            aftershock_time,
+                            rng.random(),
+                            (latitude, longitude, magnitude),
+                        ),
+                    )
+
+        event_time = event_time.replace(microsecond=0)
+        if last_time is not None and event_time <= last_time:
+            event_time = last_time + timedelta(seconds=1)
+        last_time = event_time
+
+        # Only felt earthquakes get a report number, like the CWB feeds
+        year = event_time.year - 1911
+        if magnitude >= 4:
+            numbers[year] = numbers.get(year, 0) + 1
+        yield {
+            "number": year * 1000 + (numbers.get(year, 0) if magnitude >= 4 else 0),
+            "observed_time": event_time,
+            "latitude": latitude,
+            "longitude": longitude,
+            "depth": rng.uniform(5, 60),
+            "magnitude": magnitude,
+        }
+
+
+def generate_earthquake(start_time, end_time, events_per_day, rng, batch_size=1000):
+    area_pos = get_regions().area_pos
+    areas = get_regions().earthquake_areas
+    grid = SiteGrid([area_pos[area] for area in areas])
+
+    def to_rows(events):
+        # Like the fetcher, only the areas reaching the PGA floor get a row
+        impacts = compute_impacts(
+            [
+                (
+                    event["latitude"],
+                    event["longitude"],
+                    event["depth"],
+                    event["magnitude"],
+                )
+                for event in events
+            ],
+            grid,
+        )
+        for i, j, pga, pgv in impacts:
+            yield {
+                "area": areas[j],
+                "source": rng.choice(["花蓮縣", "宜蘭縣", "臺東縣", "南投縣"]),
+                "number": events[i]["number"],
+                "pga": pga,
+                "pgv": pgv,
+                "observed_time": events[i]["observed_time"],
+            }
+
+    events = []
+    for event in generate_events(start_time, end_time, events_per_day, rng):
+        events.append(event)
+        if len(events) == batch_size:
+            yield from to_rows(events)
+            events = []
+    if events:
+        yield from to_rows(events)
+
+
+def insert_rows(rows, batch_size):
+    # rows are (model, row) pairs, each batch is one Core executemany, which
+    # the MySQL driver sends as multi-row INSERTs
+    counts = defaultdict(int)
+    batches = defaultdict(list)
+
+    def flush(model):
+        with engine.begin() as connection:
+            connection.execute(insert(model), batches[model])
+        counts[model] += len(batches[model])
+        batches[model] = []
+
+    for model, row in rows:
+        batches[model].append(row)
+        if len(batches[model]) == batch_size:
+            flush(model)
+    for model, batch in list(batches.items()):
+        if batch:
+            flush(model)
+    return counts
+
+
+def fill_latest():
+    # Point the latest_* tables at the newest generated rows, like the fetcher
+    with session_maker_modify() as db:
+        for area in get_regions().reservoir_areas:
+            reservoir = (
+                db.query(Reservoir)
+                .filter_by(area=area)
+                .order_by(desc(Reservoir.updated_time))
+                .first()
+            )
+            if reservoir is not None:
+                db.merge(
+                    LatestReservoir(
+                        area=reservoir.area,
+                        inflow=reservoir.inflow,
+                        outflow=reservoir.outflow,
+                        total_capacity=reservoir.total_capacity,
+                        current_capacity=reservoir.current_capacity,
+                        percentage=reservoir.percentage,
+                        updated_time=reservoir.updated_time,
+                    )
+                )
+
+        electricity = (
+            db.query(Electricity).order_by(desc(Electricity.updated_time)).first()
+        )
+        if electricity is not None:
+            db.merge(
+                LatestElectricity(
+                    north_generate=electricity.north_generate,
+                    north_usage=electricity.north_usage,
+                    central_generate=electricity.central_generate,
+                    central_usage=electricity.central_usage,
+                    south_generate=electricity.south_generate,
+                    south_usage=electricity.south_usage,
+                    updated_time=electricity.updated_time,
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill the database with synthetic reservoir, electricity "
+        "and earthquake history"
+    )
+    parser.add_argument("--years", type=float, default=1.0)
+    parser.add_argument(
+        "--end",
+        type=lambda value: datetime.strptime(value, "%Y-%m-%d"),
+        default=datetime.now().replace(second=0, microsecond=0),
+        help="newest day of the history (YYYY-MM-DD), now by default",
+    )
+    parser.add_argument(
+        "--density",
+        type=float,
+        default=1.0,
+        help="samples relative to the real cadences, 2 doubles every table",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--truncate", action="store_true", help="delete existing rows first"
+    )
+    args = parser.parse_args()
+
+    init_db()
+    rng = random.Random(args.seed)
+    start_time = args.end - timedelta(days=365 * args.years)
+
+    if args.truncate:
+        with engine.begin() as connection:
+            for model in (
+                Reservoir,
+                Electricity,
+                Earthquake,
+                LatestReservoir,
+                LatestElectricity,
+                FetchState,
+                ReservoirReading,
+            ):
+                connection.execute(delete(model))
+                for rollup in getattr(model, "rollups", {}).values():
+                    connection.execute(delete(rollup))
+
+    tables = {
+        (ReservoirReading, Reservoir): generate_reservoir(
+            start_time, args.end, RESERVOIR_INTERVAL / args.density, rng
+        ),
+        (Electricity,): (
+            (Electricity, row)
+            for row in generate_electricity(
+                start_time, args.end, ELECTRICITY_INTERVAL / args.density, rng
+            )
+        ),
+        (Earthquake,): (
+            (Earthquake, row)
+            for row in generate_earthquake(
+                start_time, args.end, EARTHQUAKES_PER_DAY * args.density, rng
+            )
+        ),
+    }
+    for models, rows in tables.items():
+        started = time.perf_counter()
+        counts = insert_rows(rows, args.batch_size)
+        print(
+            ", ".join(
+                f"{model.__tablename__}: {counts[model]} rows" for model in models
+            )
+            + f" in {time.perf_counter() - started:.1f}s"
+        )
+        for model in models:
+            if not hasattr(model, "rollups"):
+                continue
+            started = time.perf_counter()
+            count = rebuild_rollups(session_maker_modify, model)
+            print(
+                f"{model.__tablename__} rollups: {count} rows in "
+                f"{time.perf_counter() - started:.1f}s"
+            )
+    fill_latest()
+
+
+if __name__ == "__main__":
+    main()
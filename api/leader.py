@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import uuid
+
+from sqlalchemy import insert, or_, update
+from sqlalchemy.exc import IntegrityError
+
+# Identity of this fetcher process in the lease table
+REPLICA_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+# A replica owns a resource while its row in the lease table has not expired
+# and must renew it more often than every ttl seconds. Expired leases are taken
+# over by the first replica calling acquire. Replicas compare timestamps
+# written by each other, so their clocks are expected to be synchronized.
+class LeaderLease:
+    def __init__(self, database, instance_cls, resource, ttl, holder=None):
+        self.database = database
+        self.instance_cls = instance_cls
+        self.resource = resource
+        self.ttl = ttl
+        self.holder = holder or REPLICA_ID
+        self.expires_time = None
+
+    @property
+    def held(self):
+        return self.expires_time is not None and datetime.utcnow() < self.expires_time
+
+    def acquire(self):
+        # Take the lease if it is free or expired, or renew it if already ours
+        now = datetime.utcnow()
+        expires_time = now + timedelta(seconds=self.ttl)
+        was_held = self.held
+
+        try:
+            with self.database() as db_session:
+                result = db_session.execute(
+                    update(self.instance_cls)
+                    .where(self.instance_cls.resource == self.resource)
+                    .where(
+                        or_(
+                            self.instance_cls.holder == self.holder,
+                            self.instance_cls.expires_time < now,
+                        )
+                    )
+                    .values(holder=self.holder, expires_time=expires_time)
+                )
+                acquired = result.rowcount > 0
+                if (
+                    not acquired
+                    and db_session.get(self.instance_cls, self.resource) is None
+                ):
+                    db_session.execute(
+                        insert(self.instance_cls).values(
+                            resource=self.resource,
+                            holder=self.holder,
+                            expires_time=expires_time,
+                        )
+                    )
+                    acquired = True
+        except IntegrityError:
+            # Another replica created the lease row first
+            acquired = False
+
+        self.expires_time = expires_time if acquired else None
+        if acquired != was_held:
+            logging.info(
+                f"{self.holder} {'acquired' if acquired else 'lost'} "
+                f"the {self.resource} lease"
+            )
+        return acquired
+
+    def release(self):
+        if not self.held:
+            return
+
+        with self.database() as db_session:
+            db_session.execute(
+                update(self.instance_cls)
+                .where(self.instance_cls.resource == self.resource)
+                .where(self.instance_cls.holder == self.holder)
+                .values(expires_time=datetime.utcnow())
+            )
+        self.expires_time = None
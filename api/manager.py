@@ -1,13 +1,31 @@
 from collections import defaultdict
 from functools import wraps
+import csv
+import heapq
 import math
 from datetime import datetime, timedelta
 import os
+import random
+import time
 import requests
 
-import pandas as pd
+import numpy as np
+from sqlalchemy import and_, delete, func, insert, select
 
-from api.utils import Base, to_float, county_data
+from api import metrics
+from api.regions import get_regions
+from api.rollup import update_rollups
+from api.utils import Base, to_float, http_get, insert_new_rows
+
+# Payload of a conditional request answered with 304 Not Modified
+NOT_MODIFIED = object()
+
+# PGA in gal under which a site is neither evaluated nor stored, 0.8 gal is
+# the lower bound of intensity 1
+PGA_FLOOR = float(os.environ.get("EARTHQUAKE_PGA_FLOOR", 0.8))
+# Side in degrees of the cells the sites are bucketed in
+GRID_CELL_DEGREES = 0.5
+KM_PER_DEGREE = 111.2
 
 
 def geo_distance(geo_1, geo_2):
@@ -33,23 +51,185 @@ def compute_pga_pgv(epi_dist, focal_depth, scale, s):
     return pga, pga / 8.6561
 
 
+def geo_distance_matrix(geo_1, geo_2):
+    # Haversine distance between M points of geo_1 and N points of geo_2 (M x N)
+    geo_1 = np.radians(np.asarray(geo_1, dtype=float)[:, :2])
+    geo_2 = np.radians(np.asarray(geo_2, dtype=float)[:, :2])
+    lat1, lon1 = geo_1[:, 0, None], geo_1[:, 1, None]
+    lat2, lon2 = geo_2[None, :, 0], geo_2[None, :, 1]
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return 6373 * c
+
+
+def compute_pga_pgv_matrix(epi_dist, focal_depth, scale, s):
+    # epi_dist is M events x N sites, focal_depth and scale have one value per
+    # event and s one amplification factor per site
+    focal_depth = np.asarray(focal_depth, dtype=float)[:, None]
+    scale = np.asarray(scale, dtype=float)[:, None]
+    s = np.asarray(s, dtype=float)[None, :]
+
+    r = np.sqrt(epi_dist**2 + focal_depth**2)
+    pga = 1.657 * np.exp(1.533 * scale) * r ** (-1.607) * s
+    return pga, pga / 8.6561
+
+
+def cutoff_distance(scale, s, pga_floor):
+    # Hypocentral distance in km beyond which compute_pga_pgv stays under
+    # pga_floor for a site amplification of s
+    return (1.657 * math.exp(1.533 * scale) * s / pga_floor) ** (1 / 1.607)
+
+
+# Sites bucketed in GRID_CELL_DEGREES cells, so the sites around an epicenter
+# are found without measuring the distance to every site
+class SiteGrid:
+    def __init__(self, sites, cell_degrees=GRID_CELL_DEGREES):
+        # sites are (latitude, longitude, amplification) like county_pos
+        self.sites = np.asarray(sites, dtype=float).reshape(-1, 3)
+        self.cell_degrees = cell_degrees
+        self.max_s = float(self.sites[:, 2].max(initial=0))
+        self.cells = defaultdict(list)
+        for i, (latitude, longitude) in enumerate(self.sites[:, :2]):
+            self.cells[self.cell(latitude, longitude)].append(i)
+
+    def cell(self, latitude, longitude):
+        return (
+            math.floor(latitude / self.cell_degrees),
+            math.floor(longitude / self.cell_degrees),
+        )
+
+    def query(self, latitude, longitude, radius):
+        # Indexes of the sites within radius km and their distances
+        dlat = radius / KM_PER_DEGREE
+        dlon = radius / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        low = self.cell(latitude - dlat, longitude - dlon)
+        high = self.cell(latitude + dlat, longitude + dlon)
+        if (high[0] - low[0] + 1) * (high[1] - low[1] + 1) > len(self.cells):
+            cells = [
+                cell
+                for cell in self.cells
+                if low[0] <= cell[0] <= high[0] and low[1] <= cell[1] <= high[1]
+            ]
+        else:
+            cells = [
+                (x, y)
+                for x in range(low[0], high[0] + 1)
+                for y in range(low[1], high[1] + 1)
+                if (x, y) in self.cells
+            ]
+        indexes = np.array([i for cell in cells for i in self.cells[cell]], dtype=int)
+        if not len(indexes):
+            return indexes, np.empty(0)
+        distances = geo_distance_matrix([(latitude, longitude)], self.sites[indexes])[0]
+        return indexes[distances <= radius], distances[distances <= radius]
+
+
+def compute_impacts(events, grid, pga_floor=PGA_FLOOR):
+    # (event index, site index, pga, pgv) of every site where an event of
+    # (latitude, longitude, depth, magnitude) reaches pga_floor. Only the
+    # sites within the cutoff distance of the magnitude are evaluated.
+    impacts = []
+    for i, (latitude, longitude, depth, scale) in enumerate(events):
+        radius = cutoff_distance(scale, grid.max_s, pga_floor)
+        if radius <= depth:
+            continue
+        indexes, distances = grid.query(
+            latitude, longitude, math.sqrt(radius**2 - depth**2)
+        )
+        if not len(indexes):
+            continue
+        pga, pgv = compute_pga_pgv_matrix(
+            distances[None, :], [depth], [scale], grid.sites[indexes, 2]
+        )
+        for j, site in enumerate(indexes):
+            if pga[0, j] >= pga_floor:
+                impacts.append((i, int(site), float(pga[0, j]), float(pgv[0, j])))
+    return impacts
+
+
+def sum_readings(readings):
+    # Total of a county from one reading of each of its reservoirs
+    totals = {
+        field: sum(reading[field] for reading in readings)
+        for field in ("inflow", "outflow", "total_capacity", "current_capacity")
+    }
+    totals["percentage"] = (
+        totals["current_capacity"] / totals["total_capacity"]
+        if totals["total_capacity"]
+        else 0.0
+    )
+    totals["updated_time"] = max(reading["observed_time"] for reading in readings)
+    return totals
+
+
 class ReservoirManager(Base):
-    def __init__(self, database=None, instance_cls=None):
-        self.reservoir_overall_url = "https://data.wra.gov.tw/OpenAPI/api/OpenData/50C8256D-30C5-4B8D-9B84-2E14D5C6DF71/Data?size=1000&page=1"
-        self.reservoir_detail_url = "https://data.wra.gov.tw/OpenAPI/api/OpenData/1602CA19-B224-4CC3-AA31-11B1B124530F/Data?size=1000&page=1"
+    name = "reservoir"
+    reservoir_overall_url = "https://data.wra.gov.tw/OpenAPI/api/OpenData/50C8256D-30C5-4B8D-9B84-2E14D5C6DF71/Data?size=1000&page=1"
+    reservoir_detail_url = "https://data.wra.gov.tw/OpenAPI/api/OpenData/1602CA19-B224-4CC3-AA31-11B1B124530F/Data?size=1000&page=1"
+
+    def __init__(
+        self,
+        database=None,
+        instance_cls=None,
+        lease=None,
+        latest_cls=None,
+        reading_cls=None,
+    ):
         self.data = {
-            "新竹": {},
-            "臺中": {},
-            "臺南": {},
+            area: {"updated_time": "N/A"} for area in get_regions().reservoir_areas
         }
-        self.overall_id_update_time = {}
-        self.detail_id_update_time = {}
+        # Newest reading of every reservoir, the county totals are summed from it
+        self.readings = {}
+        # Readings not written to the database yet
+        self.rows = []
+        self.updated_areas = set()
+        self.reading_cls = reading_cls
         self.require_update_database = False
         self.updated_time = None
+        if database is not None and reading_cls is not None:
+            self.load_readings(database)
         super().__init__(
             time_pattern="%Y-%m-%dT%H:%M:%S",
             database=database,
             instance_cls=instance_cls,
+            lease=lease,
+            latest_cls=latest_cls,
+        )
+
+    def load_readings(self, database):
+        # Resume from the newest stored reading of every reservoir, so a
+        # restarted fetcher neither sees stored observations as new nor sums
+        # the counties over the reservoirs observed since the restart only
+        newest = (
+            select(
+                self.reading_cls.reservoir_id,
+                func.max(self.reading_cls.observed_time).label("observed_time"),
+            )
+            .group_by(self.reading_cls.reservoir_id)
+            .subquery()
+        )
+        with database() as db_session:
+            rows = db_session.execute(
+                select(self.reading_cls.__table__).join(
+                    newest,
+                    and_(
+                        self.reading_cls.reservoir_id == newest.c.reservoir_id,
+                        self.reading_cls.observed_time == newest.c.observed_time,
+                    ),
+                )
+            ).mappings()
+            for row in rows:
+                row = dict(row)
+                row.pop("_id")
+                self.readings[row["reservoir_id"]] = row
+
+        id_to_area = get_regions().id_to_area
+        self.aggregate_areas(
+            {id_to_area[id_] for id_ in self.readings if id_ in id_to_area}
         )
 
     def get_info(self, type_):
@@ -59,196 +239,308 @@ class ReservoirManager(Base):
             else self.reservoir_detail_url
         )
         try:
-            data = requests.get(url)
+            data = http_get(url)
             if data.status_code == 200:
                 return data.json()["responseData"]
             else:
                 raise requests.exceptions.RequestException
         except requests.exceptions.RequestException:
+            self.record_error("fetch")
             return []
 
-    def update_reservoir_overall(self):
-        overall_data = self.get_info("overall")
-        if not len(overall_data):
-            self.require_update_database = False
-            return
-
+    def get_new_readings(self, overall_data, detail_data):
+        # One reading per reservoir and observation, storage from the details
+        # and capacity and flows from the newest overall record of the reservoir
+        overall = {}
         for datum in overall_data:
+            record_time = self.format_time(datum["RecordTime"])
             id_ = datum["ReservoirIdentifier"]
+            if id_ not in overall or record_time > overall[id_][0]:
+                overall[id_] = (record_time, datum)
 
-            if id_ not in county_data["id_to_county"]:
-                continue
-
-            town_name = county_data["id_to_county"][id_]
-            if "total_capacity" not in self.data[town_name]:
-                self.data[town_name]["total_capacity"] = 0.0
-
-            if "inflow" not in self.data[town_name]:
-                self.data[town_name]["inflow"] = 0.0
-
-            if "outflow" not in self.data[town_name]:
-                self.data[town_name]["outflow"] = 0.0
-
-            if id_ in self.overall_id_update_time:
-                new_time = self.format_time(datum["RecordTime"])
-                if new_time > self.overall_id_update_time[id_][0]:
-                    self.data[town_name]["total_capacity"] += (
-                        to_float(datum["EffectiveCapacity"])
-                        - self.overall_id_update_time[id_][1]
-                    )
-                    self.overall_id_update_time[id_] = (
-                        new_time,
-                        to_float(datum["EffectiveCapacity"]),
-                    )
-            else:
-                self.data[town_name]["total_capacity"] += to_float(
-                    datum["EffectiveCapacity"]
-                )
-                self.overall_id_update_time[id_] = (
-                    self.format_time(datum["RecordTime"]),
-                    to_float(datum["EffectiveCapacity"]),
-                )
-
-            self.data[town_name]["inflow"] += to_float(datum["InflowVolume"])
-            self.data[town_name]["outflow"] += to_float(datum["OutflowTotal"])
-            self.data[town_name]["updated_time"] = datetime.now()
-        self.require_update_database = True
-
-    def update_reservoir_details(self):
-        detail_data = self.get_info("details")
-        if not len(detail_data):
-            self.require_update_database = False
-            return
-
+        readings = {}
         for datum in detail_data:
             id_ = datum["ReservoirIdentifier"]
-            if id_ not in county_data["id_to_county"]:
+            if id_ not in overall:
+                continue
+            observed_time = self.format_time(datum["ObservationTime"])
+            # Observations already ingested are skipped
+            if id_ in self.readings and (
+                observed_time <= self.readings[id_]["observed_time"]
+            ):
                 continue
 
-            town_name = county_data["id_to_county"][id_]
-
-            if "current_capacity" not in self.data[town_name]:
-                self.data[town_name]["current_capacity"] = 0.0
+            total_capacity = to_float(overall[id_][1]["EffectiveCapacity"])
+            current_capacity = to_float(datum["EffectiveWaterStorageCapacity"])
+            readings[id_, observed_time] = {
+                "reservoir_id": id_,
+                "inflow": to_float(overall[id_][1]["InflowVolume"]),
+                "outflow": to_float(overall[id_][1]["OutflowTotal"]),
+                "total_capacity": total_capacity,
+                "current_capacity": current_capacity,
+                "percentage": (
+                    current_capacity / total_capacity if total_capacity else 0.0
+                ),
+                "observed_time": observed_time,
+            }
+        return sorted(readings.values(), key=lambda row: row["observed_time"])
+
+    def aggregate_areas(self, areas):
+        # County totals over the newest reading of each of its reservoirs
+        area_to_ids = get_regions().area_to_ids
+        for area in areas:
+            self.data[area] = sum_readings(
+                [
+                    self.readings[id_]
+                    for id_ in area_to_ids[area]
+                    if id_ in self.readings
+                ]
+            )
 
-            if id_ in self.detail_id_update_time:
-                new_time = self.format_time(datum["ObservationTime"])
-                if new_time > self.detail_id_update_time[id_][0]:
-                    self.data[town_name]["current_capacity"] += (
-                        to_float(datum["EffectiveWaterStorageCapacity"])
-                        - self.detail_id_update_time[id_][1]
-                    )
-                    self.detail_id_update_time[id_] = (
-                        new_time,
-                        to_float(datum["EffectiveWaterStorageCapacity"]),
-                    )
-            else:
-                self.data[town_name]["current_capacity"] += to_float(
-                    datum["EffectiveWaterStorageCapacity"]
-                )
-                self.detail_id_update_time[id_] = (
-                    self.format_time(datum["ObservationTime"]),
-                    to_float(datum["EffectiveWaterStorageCapacity"]),
-                )
+    @property
+    def published_time(self):
+        return max(
+            (reading["observed_time"] for reading in self.readings.values()),
+            default=None,
+        )
 
-            self.data[town_name]["updated_time"] = datetime.now()
+    def fetch_sources(self):
+        return {
+            "overall": lambda: self.get_info("overall"),
+            "details": lambda: self.get_info("details"),
+        }
 
-        for key in self.data.keys():
-            self.data[key]["percentage"] = (
-                self.data[key]["current_capacity"] / self.data[key]["total_capacity"]
-            )
-        self.require_update_database = True
+    def parse(self, payloads):
+        id_to_area = get_regions().id_to_area
+        rows = self.get_new_readings(payloads["overall"], payloads["details"])
+        for row in rows:
+            self.readings[row["reservoir_id"]] = row
 
-    def update_func(self):
-        self.data = {
-            "新竹": defaultdict(float),
-            "臺中": defaultdict(float),
-            "臺南": defaultdict(float),
+        areas = {
+            id_to_area[row["reservoir_id"]]
+            for row in rows
+            if row["reservoir_id"] in id_to_area
         }
-        self.overall_id_update_time.clear()
-        self.detail_id_update_time.clear()
-        self.update_reservoir_overall()
-        self.update_reservoir_details()
+        self.aggregate_areas(areas)
+        if self.database is not None:
+            self.rows += rows
+            self.updated_areas |= areas
+        self.require_update_database = bool(rows or self.rows)
 
     def update_database(self):
         if self.database is not None and self.require_update_database:
+            id_to_area = get_regions().id_to_area
+            new_rows, skipped = [], 0
             with self.database() as db_session:
-                for town_name, town_data in self.data.items():
-                    db_session.add(
-                        self.instance_cls(
-                            area=town_name,
-                            current_capacity=town_data["current_capacity"],
-                            total_capacity=town_data["total_capacity"],
-                            percentage=town_data["percentage"],
-                            inflow=town_data["inflow"],
-                            outflow=town_data["outflow"],
-                            updated_time=town_data["updated_time"],
+                areas = self.updated_areas
+                if self.reading_cls is not None:
+                    new_rows, skipped = insert_new_rows(
+                        db_session,
+                        self.reading_cls,
+                        self.rows,
+                        key_columns=("reservoir_id", "observed_time"),
+                        time_column="observed_time",
+                    )
+                    # Counties whose readings were all stored already keep
+                    # the total written with them
+                    areas = areas & {
+                        id_to_area[row["reservoir_id"]]
+                        for row in new_rows
+                        if row["reservoir_id"] in id_to_area
+                    }
+                totals = [
+                    dict(
+                        area=town_name,
+                        current_capacity=self.data[town_name]["current_capacity"],
+                        total_capacity=self.data[town_name]["total_capacity"],
+                        percentage=self.data[town_name]["percentage"],
+                        inflow=self.data[town_name]["inflow"],
+                        outflow=self.data[town_name]["outflow"],
+                        updated_time=self.data[town_name]["updated_time"],
+                    )
+                    for town_name in sorted(areas)
+                ]
+                new_totals, _ = insert_new_rows(
+                    db_session,
+                    self.instance_cls,
+                    totals,
+                    key_columns=("area", "updated_time"),
+                    time_column="updated_time",
+                )
+                # A reservoir observed at the time of the stored total of its
+                # county changes that total. It is replaced by a new row, whose
+                # higher _id tells the ETags and /stream that the data changed.
+                rewritten = [row for row in totals if row not in new_totals]
+                for row in rewritten:
+                    db_session.execute(
+                        delete(self.instance_cls).where(
+                            self.instance_cls.area == row["area"],
+                            self.instance_cls.updated_time == row["updated_time"],
                         )
                     )
+                if rewritten:
+                    db_session.execute(insert(self.instance_cls), rewritten)
+                # Same transaction, readers never see one without the other
+                if self.latest_cls is not None:
+                    for row in totals:
+                        db_session.merge(self.latest_cls(**row))
+                update_rollups(
+                    db_session,
+                    self.instance_cls,
+                    [row["updated_time"] for row in totals],
+                )
                 self.require_update_database = False
+            self.logging.info(
+                f"Reservoir readings inserted: {len(new_rows)}, skipped: {skipped}"
+            )
+            self.count_rows(len(new_rows) + len(totals), skipped)
+            # Only cleared once committed, failed rows are retried next cycle
+            self.rows = []
+            self.updated_areas = set()
 
 
 class ElectricityManager(Base):
-    def __init__(self, database=None, instance_cls=None):
-        self.gen_use_url = "https://www.taipower.com.tw/d006/loadGraph/loadGraph/data/genloadareaperc.csv"
+    name = "electricity"
+    gen_use_url = (
+        "https://www.taipower.com.tw/d006/loadGraph/loadGraph/data/genloadareaperc.csv"
+    )
+    retries_limit = 3
+    retry_delay = 1.0
+    fetch_timeout = 90
+
+    def __init__(self, database=None, instance_cls=None, lease=None, latest_cls=None):
         self.data = None
+        self.rows = []
         self.updated_time = None
+        self.etag = None
+        self.last_modified = None
         self.require_update_database = False
         super().__init__(
-            time_pattern="%Y-%m-%d %H:%M", database=database, instance_cls=instance_cls
+            time_pattern="%Y-%m-%d %H:%M",
+            database=database,
+            instance_cls=instance_cls,
+            lease=lease,
+            latest_cls=latest_cls,
         )
 
-    def update_func(self):
-        RETRIES_LIMIT = 3
-        success = False
-        last_error = None
+    def get_info(self):
+        # Conditional, streamed download of the whole day's load curve
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
 
-        while RETRIES_LIMIT > 0:
+        last_error = None
+        for attempt in range(self.retries_limit):
+            if attempt:
+                metrics.retries_total.labels(self.name, "gen_use").inc()
+                time.sleep(
+                    self.retry_delay * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+                )
             try:
-                data = pd.read_csv(self.gen_use_url, header=None)
-                data.columns = [
-                    "time",
-                    "north_gen",
-                    "north_use",
-                    "central_gen",
-                    "central_use",
-                    "south_gen",
-                    "south_use",
-                    "east_gen",
-                    "east_use",
-                ]
-                success = True
-                break
+                with http_get(self.gen_use_url, headers=headers, stream=True) as data:
+                    if data.status_code == 304:
+                        return NOT_MODIFIED
+                    data.raise_for_status()
+                    # Without a charset in the Content-Type the lines would
+                    # stay bytes, which csv.reader refuses
+                    data.encoding = data.encoding or "utf-8"
+                    rows = list(filter(None, data.iter_lines(decode_unicode=True)))
+                    return {
+                        "rows": rows,
+                        "etag": data.headers.get("ETag"),
+                        "last_modified": data.headers.get("Last-Modified"),
+                    }
+            except requests.exceptions.HTTPError as e:
+                last_error = str(e)
+                if e.response.status_code < 500:
+                    break
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                last_error = str(e)
             except Exception as e:
+                # Invalid URL or malformed response, retrying will not help
                 last_error = str(e)
-                self.require_update_database = False
-                self.data = {
-                    "updated_time": "N/A",
-                    "north_gen": 0,
-                    "north_use": 0,
-                    "central_gen": 0,
-                    "central_use": 0,
-                    "south_gen": 0,
-                    "south_use": 0,
-                }
-            RETRIES_LIMIT -= 1
+                break
+
+        self.logging.error(f"Error: {last_error} when fetching electricity data")
+        self.record_error("fetch")
+        return None
+
+    def fetch_sources(self):
+        return {"gen_use": self.get_info}
+
+    def parse(self, payloads):
+        payload = payloads["gen_use"]
+        if payload is NOT_MODIFIED:
+            self.require_update_database = False
+            return
 
-        if not success:
-            self.logging.error(f"Error: {last_error} when fetching electricity data")
+        data = None
+        if payload is not None:
+            try:
+                data = [
+                    (self.format_time(row[0]), *(float(value) for value in row[1:7]))
+                    for row in csv.reader(payload["rows"])
+                ]
+            except (ValueError, IndexError, csv.Error) as e:
+                self.logging.error(f"Error: {e} when parsing electricity data")
+                self.record_error("parse")
 
-        if success and self.is_outdated(data.iloc[0, 0]):
+        if not data:
+            self.require_update_database = False
+            self.rows = []
+            self.data = {
+                "updated_time": "N/A",
+                "north_gen": 0,
+                "north_use": 0,
+                "central_gen": 0,
+                "central_use": 0,
+                "south_gen": 0,
+                "south_use": 0,
+            }
+            return
+
+        # Only remember the validators once the payload has been parsed
+        self.etag = payload["etag"]
+        self.last_modified = payload["last_modified"]
+        latest = max(data)
+        if self.is_outdated(latest[0]):
             self.require_update_database = True
             self.data = {
                 "updated_time": self.updated_time,
-                "north_gen": data.iloc[0, 1],
-                "north_use": data.iloc[0, 2],
-                "central_gen": data.iloc[0, 3],
-                "central_use": data.iloc[0, 4],
-                "south_gen": data.iloc[0, 5],
-                "south_use": data.iloc[0, 6],
+                "north_gen": latest[1],
+                "north_use": latest[2],
+                "central_gen": latest[3],
+                "central_use": latest[4],
+                "south_gen": latest[5],
+                "south_use": latest[6],
             }
+            # Every sample of the day is written, the ones already stored are
+            # skipped, so samples missed while the fetcher was down are filled in
+            self.rows = [
+                {
+                    "north_generate": row[1],
+                    "north_usage": row[2],
+                    "central_generate": row[3],
+                    "central_usage": row[4],
+                    "south_generate": row[5],
+                    "south_usage": row[6],
+                    "updated_time": row[0],
+                }
+                for row in data
+            ]
+
+    @property
+    def published_time(self):
+        return self.updated_time
 
     def is_outdated(self, new_time):
-        new_time = self.format_time(new_time)
+        if isinstance(new_time, str):
+            new_time = self.format_time(new_time)
         if self.updated_time is None or new_time > self.updated_time:
             self.updated_time = new_time
             return True
@@ -258,139 +550,267 @@ class ElectricityManager(Base):
     def update_database(self):
         if self.database is not None and self.require_update_database:
             with self.database() as db_session:
-                latest_data = db_session.query(self.instance_cls).first()
-                if (
-                    latest_data is not None
-                    and latest_data.updated_time == self.updated_time
-                ):
-                    return
-
-                instance = self.instance_cls(
-                    north_generate=self.data["north_gen"],
-                    north_usage=self.data["north_use"],
-                    central_generate=self.data["central_gen"],
-                    central_usage=self.data["central_use"],
-                    south_generate=self.data["south_gen"],
-                    south_usage=self.data["south_use"],
-                    updated_time=self.data["updated_time"],
+                new_rows, skipped = insert_new_rows(
+                    db_session,
+                    self.instance_cls,
+                    self.rows,
+                    key_columns=("updated_time",),
+                    time_column="updated_time",
+                )
+                update_rollups(
+                    db_session,
+                    self.instance_cls,
+                    [row["updated_time"] for row in new_rows],
                 )
-                db_session.add(instance)
+                if self.latest_cls is not None:
+                    db_session.merge(
+                        self.latest_cls(
+                            north_generate=self.data["north_gen"],
+                            north_usage=self.data["north_use"],
+                            central_generate=self.data["central_gen"],
+                            central_usage=self.data["central_use"],
+                            south_generate=self.data["south_gen"],
+                            south_usage=self.data["south_use"],
+                            updated_time=self.data["updated_time"],
+                        )
+                    )
                 self.require_update_database = False
+            self.logging.info(
+                f"Electricity rows inserted: {len(new_rows)}, skipped: {skipped}"
+            )
+            self.count_rows(len(new_rows), skipped)
 
 
 class EarthquakeManager(Base):
-    def __init__(self, database=None, instance_cls=None):
-        self.large_url = "https://opendata.cwb.gov.tw/api/v1/rest/datastore/E-A0015-001"
-        self.small_url = "https://opendata.cwb.gov.tw/api/v1/rest/datastore/E-A0016-001"
+    name = "earthquake"
+    large_url = "https://opendata.cwb.gov.tw/api/v1/rest/datastore/E-A0015-001"
+    small_url = "https://opendata.cwb.gov.tw/api/v1/rest/datastore/E-A0016-001"
+    # Earthquakes kept in memory, older ones are evicted every cycle
+    window = timedelta(days=30)
+
+    def __init__(self, database=None, instance_cls=None, lease=None, state_cls=None):
         self.auth = os.environ.get("CWB_AUTH")
         self.require_update_database = False
-        self.data = {
-            "新竹": [],
-            "臺中": [],
-            "臺南": [],
-        }
+        # Newest first, new earthquakes are merged in and old ones popped off
+        self.data = {area: [] for area in get_regions().earthquake_areas}
+        self.grid = SiteGrid([get_regions().area_pos[area] for area in self.data])
+        # Rows not written to the database yet
+        self.rows = []
         self.updated_time = datetime.now()
+        self.state_cls = state_cls
+        # Newest (OriginTime, EarthquakeNo) ingested from each feed, only the
+        # earthquakes after it are requested and parsed
+        self.watermarks = {"l": None, "s": None}
+        if database is not None and state_cls is not None:
+            self.load_state(database, instance_cls)
+        # Watermarks as stored in the database
+        self.stored_watermarks = dict(self.watermarks)
         super().__init__(
             time_pattern="%Y-%m-%d %H:%M:%S",
             database=database,
             instance_cls=instance_cls,
+            lease=lease,
         )
 
-    def reset(self):
-        self.data = {
-            "新竹": [],
-            "臺中": [],
-            "臺南": [],
-        }
+    def load_state(self, database, instance_cls):
+        # Resume from the stored watermarks with the window read back from the
+        # database, instead of downloading 30 days again
+        with database() as db_session:
+            for type_ in self.watermarks:
+                state = db_session.get(self.state_cls, f"{self.name}_{type_}")
+                if state is not None:
+                    self.watermarks[type_] = (state.observed_time, state.number)
+            if not any(self.watermarks.values()):
+                return
+
+            rows = db_session.execute(
+                select(instance_cls)
+                .where(instance_cls.observed_time >= self.updated_time - self.window)
+                .order_by(instance_cls.observed_time.desc(), instance_cls._id.desc())
+            ).scalars()
+            for row in rows:
+                if row.area in self.data:
+                    self.data[row.area].append(
+                        {
+                            "source": row.source,
+                            "number": row.number,
+                            "observed_time": row.observed_time,
+                            "pga": row.pga,
+                            "pgv": row.pgv,
+                        }
+                    )
 
     def get_thirty_day_str(self):
         # Reference: 2023-03-03T00:00:00
-        return datetime.strftime(
-            self.updated_time - timedelta(days=30), "%Y-%m-%dT%H:%M:%S"
-        )
+        return datetime.strftime(self.updated_time - self.window, "%Y-%m-%dT%H:%M:%S")
+
+    def get_time_from(self, type_):
+        watermark = self.watermarks[type_]
+        if watermark is None or watermark[0] < self.updated_time - self.window:
+            return self.get_thirty_day_str()
+        # Inclusive, the earthquakes at the watermark are filtered out in parse
+        return datetime.strftime(watermark[0], "%Y-%m-%dT%H:%M:%S")
 
     def process_data(self, data):
-        for earthquake in data:
-            earthquake_info = earthquake["EarthquakeInfo"]
-            earthquake_number = earthquake["EarthquakeNo"]
-            time = earthquake_info["OriginTime"]
-            depth = earthquake_info["FocalDepth"]
-            magnitude = earthquake_info["EarthquakeMagnitude"]["MagnitudeValue"]
-            center = earthquake_info["Epicenter"]
-            latitude = center["EpicenterLatitude"]
-            longitude = center["EpicenterLongitude"]
-            location = center["Location"]
-
-            for area in self.data:
-                pga, pgv = compute_pga_pgv(
-                    geo_distance(
-                        county_data["county_pos"][area],
-                        (latitude, longitude),
-                    ),
-                    depth,
-                    magnitude,
-                    county_data["county_pos"][area][2],
+        # New earthquakes of each area, newest first
+        new_data = {area: [] for area in self.data}
+        if not data:
+            return new_data
+
+        areas = list(self.data)
+        infos = [earthquake["EarthquakeInfo"] for earthquake in data]
+        impacts = compute_impacts(
+            [
+                (
+                    float(info["Epicenter"]["EpicenterLatitude"]),
+                    float(info["Epicenter"]["EpicenterLongitude"]),
+                    float(info["FocalDepth"]),
+                    float(info["EarthquakeMagnitude"]["MagnitudeValue"]),
                 )
-                self.data[area].append(
-                    {
-                        "source": location[:3],
-                        "number": earthquake_number,
-                        "observed_time": self.format_time(time),
-                        "pga": pga,
-                        "pgv": pgv,
-                    }
+                for info in infos
+            ],
+            self.grid,
+        )
+
+        observed_times = [self.format_time(info["OriginTime"]) for info in infos]
+        for i, j, pga, pgv in impacts:
+            new_data[areas[j]].append(
+                {
+                    "source": infos[i]["Epicenter"]["Location"][:3],
+                    "number": data[i]["EarthquakeNo"],
+                    "observed_time": observed_times[i],
+                    "pga": pga,
+                    "pgv": pgv,
+                }
+            )
+        for earthquake_data in new_data.values():
+            earthquake_data.sort(key=lambda x: x["observed_time"], reverse=True)
+        return new_data
+
+    def merge_window(self, new_data):
+        cutoff = self.updated_time - self.window
+        for area, earthquake_data in self.data.items():
+            if new_data[area]:
+                earthquake_data = self.data[area] = list(
+                    heapq.merge(
+                        new_data[area],
+                        earthquake_data,
+                        key=lambda x: x["observed_time"],
+                        reverse=True,
+                    )
                 )
+            while earthquake_data and earthquake_data[-1]["observed_time"] < cutoff:
+                earthquake_data.pop()
 
     def get_info(self, type_="s"):
         use_url = self.large_url if type_ == "l" else self.small_url
-        data = requests.get(
-            f"{use_url}?Authorization={self.auth}&format=JSON&timeFrom={self.get_thirty_day_str()}"
-        )
+        try:
+            data = http_get(
+                f"{use_url}?Authorization={self.auth}&format=JSON&timeFrom={self.get_time_from(type_)}"
+            )
+        except requests.exceptions.RequestException as e:
+            self.logging.error(f"Error: {e} when fetching earthquake data")
+            self.record_error("fetch")
+            return None
+
         if data.status_code == 200:
-            self.require_update_database = True
             return data.json()["records"]["Earthquake"]
         else:
-            self.require_update_database = False
             self.logging.error(
                 f"Error: {data.status_code} code when fetching earthquake data"
             )
-            return {}
+            self.record_error("fetch")
+            return None
+
+    @property
+    def published_time(self):
+        return max(
+            (
+                earthquake_data[0]["observed_time"]
+                for earthquake_data in self.data.values()
+                if earthquake_data
+            ),
+            default=None,
+        )
 
-    def sort_earthquake_by_time(self):
-        for key in self.data.keys():
-            self.data[key].sort(key=lambda x: x["observed_time"], reverse=True)
+    def fetch_sources(self):
+        self.updated_time = datetime.now()
+        return {
+            "l": lambda: self.get_info("l"),
+            "s": lambda: self.get_info("s"),
+        }
 
-    def update_func(self):
-        self.reset()
-        self.process_data(self.get_info("l"))
-        self.process_data(self.get_info("s"))
-        self.sort_earthquake_by_time()
+    def parse(self, payloads):
+        self.require_update_database = False
+        data = []
+        for type_ in ("l", "s"):
+            if payloads[type_] is None:
+                continue
+            self.require_update_database = True
+            # Compared with the watermark of the previous cycle, the feeds list
+            # the newest earthquakes first
+            watermark = self.watermarks[type_]
+            for earthquake in payloads[type_]:
+                key = (
+                    self.format_time(earthquake["EarthquakeInfo"]["OriginTime"]),
+                    earthquake["EarthquakeNo"],
+                )
+                if watermark is None or key > watermark:
+                    data.append(earthquake)
+                    self.watermarks[type_] = max(key, self.watermarks[type_] or key)
+
+        new_data = self.process_data(data)
+        self.merge_window(new_data)
+        if self.database is not None:
+            self.rows += [
+                {"area": area, **earthquake_datum}
+                for area, earthquake_data in new_data.items()
+                for earthquake_datum in earthquake_data
+            ]
 
     def update_database(self):
         if self.database is not None and self.require_update_database:
-            with self.database() as db_session:
-                for town_name, earthquake_data in self.data.items():
-                    for earthquake_datum in earthquake_data:
-                        earthquake_observed_time = earthquake_datum["observed_time"]
-                        if (
-                            db_session.query(self.instance_cls)
-                            .filter(
-                                self.instance_cls.observed_time
-                                == earthquake_observed_time
-                            )
-                            .filter(self.instance_cls.area == town_name)
-                            .first()
-                            is not None
-                        ):
-                            continue
-
-                        db_session.add(
-                            self.instance_cls(
-                                area=town_name,
-                                source=earthquake_datum["source"],
-                                pga=earthquake_datum["pga"],
-                                pgv=earthquake_datum["pgv"],
-                                observed_time=earthquake_datum["observed_time"],
+            new_rows, skipped = [], 0
+            # The watermarks are stored even when every new earthquake was
+            # under the PGA floor, so they are not fetched again after a restart
+            watermarks = (
+                {
+                    type_: watermark
+                    for type_, watermark in self.watermarks.items()
+                    if watermark is not None
+                    and watermark != self.stored_watermarks[type_]
+                }
+                if self.state_cls is not None
+                else {}
+            )
+            if self.rows or watermarks:
+                with self.database() as db_session:
+                    new_rows, skipped = insert_new_rows(
+                        db_session,
+                        self.instance_cls,
+                        self.rows,
+                        key_columns=("area", "observed_time", "number"),
+                        time_column="observed_time",
+                    )
+                    update_rollups(
+                        db_session,
+                        self.instance_cls,
+                        [row["observed_time"] for row in new_rows],
+                    )
+                    # Same transaction, the watermarks never get ahead of the rows
+                    for type_, watermark in watermarks.items():
+                        db_session.merge(
+                            self.state_cls(
+                                resource=f"{self.name}_{type_}",
+                                observed_time=watermark[0],
+                                number=watermark[1],
                             )
                         )
-                self.require_update_database = False
+                # Only cleared once committed, failed rows are retried next cycle
+                self.rows = []
+                self.stored_watermarks.update(watermarks)
+            self.require_update_database = False
+            self.logging.info(
+                f"Earthquake rows inserted: {len(new_rows)}, skipped: {skipped}"
+            )
+            self.count_rows(len(new_rows), skipped)
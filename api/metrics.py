@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+import math
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Series of the fetcher, labelled by manager ("reservoir", "electricity", ...)
+upstream_seconds = Histogram(
+    "fetcher_upstream_seconds",
+    "Time to fetch one upstream source, retries included",
+    ["manager", "source"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 90),
+)
+parse_seconds = Histogram(
+    "fetcher_parse_seconds", "Time to parse the payloads of one cycle", ["manager"]
+)
+write_seconds = Histogram(
+    "fetcher_db_write_seconds",
+    "Time to write one cycle to the database",
+    ["manager"],
+)
+rows_total = Counter(
+    "fetcher_rows_total",
+    "Rows written, or skipped because they were already stored",
+    ["manager", "result"],
+)
+retries_total = Counter(
+    "fetcher_retries_total", "Upstream requests retried", ["manager", "source"]
+)
+errors_total = Counter(
+    "fetcher_errors_total",
+    "Failures by stage: fetch, parse, write or timeout",
+    ["manager", "stage"],
+)
+seconds_since_update = Gauge(
+    "fetcher_seconds_since_last_update",
+    "Seconds since the last cycle written to the database, NaN before the first",
+    ["manager"],
+)
+
+last_update_times = {}
+
+
+def register(manager):
+    if manager not in last_update_times:
+        last_update_times[manager] = None
+        seconds_since_update.labels(manager).set_function(
+            lambda: (
+                math.nan
+                if last_update_times[manager] is None
+                else time.time() - last_update_times[manager]
+            )
+        )
+
+
+def mark_updated(manager):
+    last_update_times[manager] = time.time()
+
+
+@contextmanager
+def timed(histogram, manager, stage):
+    # Observes the duration, and counts an error when the block raises
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors_total.labels(manager, stage).inc()
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+def start_metrics_server(port):
+    # Serves the default registry, the DB pool series included, on /metrics
+    start_http_server(port)
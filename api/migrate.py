@@ -0,0 +1,60 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+# Columns added to tables that may predate them, with the DDL filling the
+# existing rows
+ADDED_COLUMNS = (("earthquake", "number", "INTEGER NOT NULL DEFAULT 0"),)
+# Unique keys added to tables that may predate them, duplicates of a key are
+# deleted first, keeping the newest row
+UNIQUE_KEYS = (
+    ("earthquake", "uq_earthquake_event", ("area", "observed_time", "number")),
+    ("electricity", "uq_electricity_updated_time", ("updated_time",)),
+    ("reservoir", "uq_reservoir_area_time", ("area", "updated_time")),
+)
+
+
+def unique_keys(inspector, table_name):
+    # SQLite reports keys created with CREATE UNIQUE INDEX as indexes only
+    names = {key["name"] for key in inspector.get_unique_constraints(table_name)}
+    names.update(
+        index["name"] for index in inspector.get_indexes(table_name) if index["unique"]
+    )
+    return names
+
+
+def deduplicate(connection, table_name, columns):
+    # MySQL cannot select from the table it deletes from, hence the derived table
+    key = ", ".join(columns)
+    return connection.execute(
+        text(
+            f"DELETE FROM {table_name} WHERE _id NOT IN (SELECT _id FROM "
+            f"(SELECT MAX(_id) AS _id FROM {table_name} GROUP BY {key}) AS kept)"
+        )
+    ).rowcount
+
+
+def migrate_schema(engine):
+    # create_all() leaves existing tables alone, every step is skipped once applied
+    inspector = inspect(engine)
+    for table_name, column, definition in ADDED_COLUMNS:
+        if column in {item["name"] for item in inspector.get_columns(table_name)}:
+            continue
+        with engine.begin() as connection:
+            connection.execute(
+                text(f"ALTER TABLE {table_name} ADD COLUMN {column} {definition}")
+            )
+        logging.info(f"Added {table_name}.{column}")
+    for table_name, name, columns in UNIQUE_KEYS:
+        if name in unique_keys(inspector, table_name):
+            continue
+        # DDL commits on its own in MySQL, the delete is committed before it
+        with engine.begin() as connection:
+            count = deduplicate(connection, table_name, columns)
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"CREATE UNIQUE INDEX {name} ON {table_name} ({', '.join(columns)})"
+                )
+            )
+        logging.info(f"Deleted {count} duplicate {table_name} rows, added {name}")
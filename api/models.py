@@ -1,13 +1,20 @@
 from pathlib import Path
 import sys
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, UniqueConstraint
 
 sys.path.append(Path(__file__).resolve().parent.parent.__str__())
 from api.database import Base
+from api.rollup import AGGREGATES
 
 
 class Reservoir(Base):
     __tablename__ = "reservoir"
+    # A total rewritten by the fetcher is replaced by a new row, its _id must
+    # never be reused, which SQLite only guarantees with AUTOINCREMENT
+    __table_args__ = (
+        UniqueConstraint("area", "updated_time", name="uq_reservoir_area_time"),
+        {"sqlite_autoincrement": True},
+    )
     _id = Column(Integer, primary_key=True)
     area = Column(String(30), index=True, nullable=False)
     inflow = Column(Float, nullable=False)
@@ -36,8 +43,46 @@ class Reservoir(Base):
         self.updated_time = updated_time
 
 
+class ReservoirReading(Base):
+    # One row per reservoir and observation, the reservoir table holds the
+    # county totals derived from them
+    __tablename__ = "reservoir_reading"
+    __table_args__ = (
+        UniqueConstraint("reservoir_id", "observed_time", name="uq_reservoir_reading"),
+    )
+    _id = Column(Integer, primary_key=True)
+    reservoir_id = Column(String(10), nullable=False)
+    inflow = Column(Float, nullable=False)
+    outflow = Column(Float, nullable=False)
+    total_capacity = Column(Float, nullable=False)
+    current_capacity = Column(Float, nullable=False)
+    percentage = Column(Float, nullable=False)
+    observed_time = Column(DateTime, index=True, nullable=False)
+
+    def __init__(
+        self,
+        reservoir_id,
+        inflow,
+        outflow,
+        total_capacity,
+        current_capacity,
+        percentage,
+        observed_time,
+    ):
+        self.reservoir_id = reservoir_id
+        self.inflow = inflow
+        self.outflow = outflow
+        self.total_capacity = total_capacity
+        self.current_capacity = current_capacity
+        self.percentage = percentage
+        self.observed_time = observed_time
+
+
 class Electricity(Base):
     __tablename__ = "electricity"
+    __table_args__ = (
+        UniqueConstraint("updated_time", name="uq_electricity_updated_time"),
+    )
     _id = Column(Integer, primary_key=True)
     north_generate = Column(Float, nullable=False)
     north_usage = Column(Float, nullable=False)
@@ -45,7 +90,7 @@ class Electricity(Base):
     central_usage = Column(Float, nullable=False)
     south_generate = Column(Float, nullable=False)
     south_usage = Column(Float, nullable=False)
-    updated_time = Column(DateTime, index=True, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
 
     def __init__(
         self,
@@ -68,16 +113,189 @@ class Electricity(Base):
 
 class Earthquake(Base):
     __tablename__ = "earthquake"
+    __table_args__ = (
+        UniqueConstraint("area", "observed_time", "number", name="uq_earthquake_event"),
+    )
     _id = Column(Integer, primary_key=True)
     area = Column(String(20), index=True, nullable=False)
     source = Column(String(20), nullable=False)
+    number = Column(Integer, nullable=False, default=0)
     pga = Column(Float, nullable=False)
     pgv = Column(Float, nullable=False)
     observed_time = Column(DateTime, index=True, nullable=False)
 
-    def __init__(self, area, source, pga, pgv, observed_time):
+    def __init__(self, area, source, number, pga, pgv, observed_time):
         self.area = area
         self.source = source
+        self.number = number
         self.pga = pga
         self.pgv = pgv
         self.observed_time = observed_time
+
+
+class LatestReservoir(Base):
+    # Newest row of each area, upserted by the fetcher with every history insert
+    __tablename__ = "latest_reservoir"
+    area = Column(String(30), primary_key=True)
+    inflow = Column(Float, nullable=False)
+    outflow = Column(Float, nullable=False)
+    total_capacity = Column(Float, nullable=False)
+    current_capacity = Column(Float, nullable=False)
+    percentage = Column(Float, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+
+    def __init__(
+        self,
+        area,
+        inflow,
+        outflow,
+        total_capacity,
+        current_capacity,
+        percentage,
+        updated_time,
+    ):
+        self.area = area
+        self.inflow = inflow
+        self.outflow = outflow
+        self.total_capacity = total_capacity
+        self.current_capacity = current_capacity
+        self.percentage = percentage
+        self.updated_time = updated_time
+
+
+class LatestElectricity(Base):
+    # Single row holding the newest sample of the electricity table
+    __tablename__ = "latest_electricity"
+    resource = Column(String(30), primary_key=True)
+    north_generate = Column(Float, nullable=False)
+    north_usage = Column(Float, nullable=False)
+    central_generate = Column(Float, nullable=False)
+    central_usage = Column(Float, nullable=False)
+    south_generate = Column(Float, nullable=False)
+    south_usage = Column(Float, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+
+    def __init__(
+        self,
+        north_generate,
+        north_usage,
+        central_generate,
+        central_usage,
+        south_generate,
+        south_usage,
+        updated_time,
+        resource="electricity",
+    ):
+        self.resource = resource
+        self.north_generate = north_generate
+        self.north_usage = north_usage
+        self.central_generate = central_generate
+        self.central_usage = central_usage
+        self.south_generate = south_generate
+        self.south_usage = south_usage
+        self.updated_time = updated_time
+
+
+def rollup_model(class_name, source, bucket, time_field, fields, group_field=None):
+    # Mean, min, max and last value of every field and the number of raw rows
+    # in each bucket, kept up to date by the fetcher with api.rollup
+    table_name = f"{source.__tablename__}_{ROLLUP_SUFFIXES[bucket]}"
+    group_columns = [group_field] if group_field else []
+    attributes = {
+        "__tablename__": table_name,
+        "__table_args__": (
+            UniqueConstraint(*group_columns, time_field, name=f"uq_{table_name}"),
+        ),
+        "_id": Column(Integer, primary_key=True),
+        "count": Column(Integer, nullable=False),
+        time_field: Column(DateTime, index=True, nullable=False),
+        "bucket": bucket,
+        "time_field": time_field,
+        "group_field": group_field,
+        "fields": fields,
+    }
+    if group_field:
+        attributes[group_field] = Column(String(30), nullable=False)
+    for field in fields:
+        for aggregate in AGGREGATES:
+            attributes[f"{field}_{aggregate}"] = Column(Float, nullable=False)
+    return type(class_name, (Base,), attributes)
+
+
+ROLLUP_SUFFIXES = {"1h": "hourly", "1d": "daily"}
+RESERVOIR_ROLLUP_FIELDS = (
+    "inflow",
+    "outflow",
+    "total_capacity",
+    "current_capacity",
+    "percentage",
+)
+ELECTRICITY_ROLLUP_FIELDS = (
+    "north_generate",
+    "north_usage",
+    "central_generate",
+    "central_usage",
+    "south_generate",
+    "south_usage",
+)
+EARTHQUAKE_ROLLUP_FIELDS = ("pga", "pgv")
+
+ReservoirHourly = rollup_model(
+    "ReservoirHourly", Reservoir, "1h", "updated_time", RESERVOIR_ROLLUP_FIELDS, "area"
+)
+ReservoirDaily = rollup_model(
+    "ReservoirDaily", Reservoir, "1d", "updated_time", RESERVOIR_ROLLUP_FIELDS, "area"
+)
+ElectricityHourly = rollup_model(
+    "ElectricityHourly", Electricity, "1h", "updated_time", ELECTRICITY_ROLLUP_FIELDS
+)
+ElectricityDaily = rollup_model(
+    "ElectricityDaily", Electricity, "1d", "updated_time", ELECTRICITY_ROLLUP_FIELDS
+)
+EarthquakeHourly = rollup_model(
+    "EarthquakeHourly",
+    Earthquake,
+    "1h",
+    "observed_time",
+    EARTHQUAKE_ROLLUP_FIELDS,
+    "area",
+)
+EarthquakeDaily = rollup_model(
+    "EarthquakeDaily",
+    Earthquake,
+    "1d",
+    "observed_time",
+    EARTHQUAKE_ROLLUP_FIELDS,
+    "area",
+)
+
+# Rollups of each raw table by bucket, finest first
+Reservoir.rollups = {"1h": ReservoirHourly, "1d": ReservoirDaily}
+Electricity.rollups = {"1h": ElectricityHourly, "1d": ElectricityDaily}
+Earthquake.rollups = {"1h": EarthquakeHourly, "1d": EarthquakeDaily}
+
+
+class Lease(Base):
+    __tablename__ = "lease"
+    resource = Column(String(30), primary_key=True)
+    holder = Column(String(100), nullable=False)
+    expires_time = Column(DateTime, nullable=False)
+
+    def __init__(self, resource, holder, expires_time):
+        self.resource = resource
+        self.holder = holder
+        self.expires_time = expires_time
+
+
+class FetchState(Base):
+    # Newest upstream record ingested by a fetcher feed, so a restarted fetcher
+    # only requests what came after it
+    __tablename__ = "fetch_state"
+    resource = Column(String(30), primary_key=True)
+    number = Column(Integer, nullable=False, default=0)
+    observed_time = Column(DateTime, nullable=False)
+
+    def __init__(self, resource, number, observed_time):
+        self.resource = resource
+        self.number = number
+        self.observed_time = observed_time
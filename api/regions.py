@@ -0,0 +1,46 @@
+from pathlib import Path
+import functools
+import json
+
+COUNTY_DATA_FILE = Path(__file__).resolve().parent.parent / "county_data.json"
+
+
+def town_area(town_name):
+    # "新北市新店區" -> "新北", named like the counties of id_to_county
+    return town_name[:3].replace("巿", "市").rstrip("縣市")
+
+
+# The counties of county_data.json and the indexes the managers and views
+# iterate, so a county is added by editing the file only. Counties with
+# coordinates get earthquake intensities, counties with reservoirs get
+# reservoir totals.
+class Regions:
+    def __init__(self, county_data):
+        self.id_to_name = county_data["id_to_name"]
+        # Every reservoir belongs to the county of its town, unless id_to_county
+        # assigns it to the county it supplies
+        self.id_to_area = {
+            id_: town_area(town_name)
+            for id_, town_name in county_data.get("id_to_town_name", {}).items()
+        }
+        self.id_to_area.update(county_data["id_to_county"])
+        self.area_pos = {
+            area: tuple(pos) for area, pos in county_data["county_pos"].items()
+        }
+        self.area_to_ids = {}
+        for id_, area in self.id_to_area.items():
+            self.area_to_ids.setdefault(area, []).append(id_)
+
+        # Counties with coordinates first, in the order of the file
+        self.areas = list(self.area_pos) + [
+            area for area in self.area_to_ids if area not in self.area_pos
+        ]
+        self.reservoir_areas = [area for area in self.areas if area in self.area_to_ids]
+        self.earthquake_areas = list(self.area_pos)
+
+
+# Built on first use and shared by every manager and view afterwards
+@functools.lru_cache(maxsize=None)
+def get_regions():
+    with open(COUNTY_DATA_FILE, "r", encoding="utf-8") as f:
+        return Regions(json.load(f))
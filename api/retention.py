@@ -0,0 +1,325 @@
+from datetime import date, datetime
+from pathlib import Path
+import itertools
+import logging
+import os
+import sys
+
+from sqlalchemy import delete, func, select, text
+import dotenv
+
+dotenv.load_dotenv(".env")
+
+# Months kept in the database, older months are moved to Parquet archives
+RETENTION_MONTHS = int(os.environ.get("RETENTION_MONTHS", 24))
+ARCHIVE_DIR = Path(os.environ.get("ARCHIVE_DIR", "archive"))
+# Empty partitions created ahead so inserts never land in the catch-all one
+PARTITIONS_AHEAD = 2
+FUTURE_PARTITION = "pfuture"
+# Rows per Parquet row group, whose min/max statistics let a range read skip
+# the rest of a month, and rows converted to Python objects at a time
+ARCHIVE_ROW_GROUP_SIZE = 65536
+ARCHIVE_BATCH_SIZE = 4096
+# TO_DAYS() of MySQL counts from year 0, date.toordinal() from year 1
+TO_DAYS_OFFSET = 365
+
+
+def month_start(row_time):
+    return row_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+def month_range(first_month, last_month):
+    month = month_start(first_month)
+    while month <= last_month:
+        yield month
+        month = add_months(month, 1)
+
+
+def archive_path(table_name, month):
+    return ARCHIVE_DIR / table_name / f"{month:%Y-%m}.parquet"
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def write_archive(connection, model, time_field, month):
+    # Written to a temporary file first, a half written archive is never read
+    import pyarrow
+    import pyarrow.parquet
+
+    time_column = getattr(model, time_field)
+    rows = [
+        dict(row)
+        for row in connection.execute(
+            select(model.__table__)
+            .where(time_column >= month, time_column < add_months(month, 1))
+            .order_by(time_column, model._id)
+        ).mappings()
+    ]
+    if not rows:
+        return 0
+
+    count = len(rows)
+    path = archive_path(model.__tablename__, month)
+    if path.exists():
+        # Late rows of a month archived before are merged with the rows it
+        # holds, a row archived twice is kept once. _id alone is not enough,
+        # the ids of archived rows can be handed out again.
+        def key(row):
+            return row[time_field], row["_id"]
+
+        keys = {key(row) for row in rows}
+        rows = sorted(
+            [
+                row
+                for row in pyarrow.parquet.read_table(path).to_pylist()
+                if key(row) not in keys
+            ]
+            + rows,
+            key=key,
+        )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    pyarrow.parquet.write_table(
+        pyarrow.Table.from_pylist(rows),
+        temp_path,
+        compression="zstd",
+        row_group_size=ARCHIVE_ROW_GROUP_SIZE,
+    )
+    os.replace(temp_path, path)
+    return count
+
+
+def archive_paths(table_name, start_time, end_time):
+    return [
+        archive_path(table_name, month)
+        for month in month_range(start_time, end_time)
+        if archive_path(table_name, month).exists()
+    ]
+
+
+def archive_filter(time_field, start_time, end_time, match=None, after=None):
+    import pyarrow.dataset
+
+    field = pyarrow.dataset.field
+    expression = (field(time_field) >= start_time) & (field(time_field) <= end_time)
+    for column, value in (match or {}).items():
+        expression &= field(column) == value
+    if after is not None:
+        expression &= (field(time_field) > after[0]) | (
+            (field(time_field) == after[0]) & (field("_id") > after[1])
+        )
+    return expression
+
+
+def read_archive(
+    table_name, columns, time_field, start_time, end_time, match=None, after=None
+):
+    # Rows of [start_time, end_time] from the months already archived, in
+    # (time, _id) order like they were written, or None when no month of the
+    # range is archived. match maps columns to the only value their rows may
+    # have and after is a (time, _id) cursor; both are pushed into the scan
+    # with the range, so only the row groups that can match are read.
+    # pyarrow is only imported when such a month is requested.
+    paths = archive_paths(table_name, start_time, end_time)
+    if not paths:
+        return None
+
+    import pyarrow.dataset
+
+    expression = archive_filter(time_field, start_time, end_time, match, after)
+
+    def rows():
+        # One month after the other and without threads, batches keep the
+        # order of the file
+        for path in paths:
+            for batch in pyarrow.dataset.dataset(path, format="parquet").to_batches(
+                columns=list(columns),
+                filter=expression,
+                batch_size=ARCHIVE_BATCH_SIZE,
+                use_threads=False,
+            ):
+                yield from batch.to_pylist()
+
+    return rows()
+
+
+def read_archive_groups(
+    table_name, columns, time_field, group_field, start_time, end_time, match=None
+):
+    # Like read_archive, in (group, time, _id) order. Only the group column is
+    # read to find the groups, then every group is streamed with its value
+    # pushed into the scan, nothing is sorted in memory.
+    paths = archive_paths(table_name, start_time, end_time)
+    if not paths:
+        return None
+
+    import pyarrow.dataset
+
+    groups = (
+        pyarrow.dataset.dataset(paths, format="parquet")
+        .to_table(
+            columns=[group_field],
+            filter=archive_filter(time_field, start_time, end_time, match),
+        )
+        .column(group_field)
+        .unique()
+        .to_pylist()
+    )
+    return itertools.chain.from_iterable(
+        read_archive(
+            table_name,
+            columns,
+            time_field,
+            start_time,
+            end_time,
+            match={**(match or {}), group_field: group},
+        )
+        for group in sorted(groups)
+    )
+
+
+def get_partitions(connection, table_name):
+    # (name, first day after the partition) of every partition, in order,
+    # the catch-all one has no bound
+    partitions = []
+    for name, description in connection.execute(
+        text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+            "FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name "
+            "AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION"
+        ),
+        {"table_name": table_name},
+    ):
+        partitions.append((name, parse_partition_bound(description)))
+    return partitions
+
+
+def parse_partition_bound(description):
+    # VALUES LESS THAN of a TO_DAYS() range partition, as a datetime
+    if description is None or description.upper() == "MAXVALUE":
+        return None
+    return datetime.combine(
+        date.fromordinal(int(description) - TO_DAYS_OFFSET), datetime.min.time()
+    )
+
+
+def partition_definitions(months):
+    definitions = [
+        f"PARTITION {partition_name(month)} VALUES LESS THAN "
+        f"(TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))"
+        for month in months
+    ]
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    return ", ".join(definitions)
+
+
+def create_partitions(connection, model, time_field, now):
+    # MySQL only: monthly RANGE partitions on TO_DAYS(time). Every unique key
+    # has to contain the partitioning column, so the primary key becomes
+    # (_id, time); _id stays unique through AUTO_INCREMENT.
+    table_name = model.__tablename__
+    last_month = add_months(month_start(now), PARTITIONS_AHEAD)
+    partitions = get_partitions(connection, table_name)
+
+    if not partitions:
+        first_time = connection.execute(
+            select(func.min(getattr(model, time_field)))
+        ).scalar()
+        connection.execute(
+            text(
+                f"ALTER TABLE {table_name} DROP PRIMARY KEY, "
+                f"ADD PRIMARY KEY (_id, {time_field})"
+            )
+        )
+        connection.execute(
+            text(
+                f"ALTER TABLE {table_name} PARTITION BY RANGE "
+                f"(TO_DAYS({time_field})) ("
+                + partition_definitions(month_range(first_time or now, last_month))
+                + ")"
+            )
+        )
+        logging.info(f"Partitioned {table_name} by month")
+        return
+
+    # Split the empty catch-all partition into the months after the highest
+    # bound, whatever the names and the spans of the partitions below it
+    newest = max(
+        (bound for _, bound in partitions if bound is not None),
+        default=month_start(now),
+    )
+    months = list(month_range(newest, last_month))
+    if months:
+        connection.execute(
+            text(
+                f"ALTER TABLE {table_name} REORGANIZE PARTITION "
+                f"{FUTURE_PARTITION} INTO (" + partition_definitions(months) + ")"
+            )
+        )
+
+
+def expire_months(connection, model, time_field, now):
+    # Archive every month older than the retention window, then drop it
+    table_name = model.__tablename__
+    time_column = getattr(model, time_field)
+    cutoff = add_months(month_start(now), -RETENTION_MONTHS)
+    first_time = connection.execute(
+        select(func.min(time_column)).where(time_column < cutoff)
+    ).scalar()
+    if first_time is None:
+        return
+
+    for month in month_range(first_time, add_months(cutoff, -1)):
+        count = write_archive(connection, model, time_field, month)
+        logging.info(f"Archived {count} {table_name} rows of {month:%Y-%m}")
+
+    # Every row before the cutoff is archived now. The partitions entirely
+    # before it are dropped by their bound, the rows left are deleted.
+    if connection.dialect.name == "mysql":
+        for name, bound in get_partitions(connection, table_name):
+            if bound is not None and bound <= cutoff:
+                connection.execute(
+                    text(f"ALTER TABLE {table_name} DROP PARTITION {name}")
+                )
+    connection.execute(delete(model).where(time_column < cutoff))
+
+
+def maintain_storage(engine, now=None):
+    from api.models import Reservoir, ReservoirReading, Electricity, Earthquake
+
+    now = now or datetime.now()
+    for model, time_field in (
+        (Reservoir, "updated_time"),
+        (ReservoirReading, "observed_time"),
+        (Electricity, "updated_time"),
+        (Earthquake, "observed_time"),
+    ):
+        # DDL commits on its own in MySQL, each table gets its own transaction
+        with engine.begin() as connection:
+            if connection.dialect.name == "mysql":
+                create_partitions(connection, model, time_field, now)
+            if RETENTION_MONTHS > 0:
+                expire_months(connection, model, time_field, now)
+
+
+def main():
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    os.environ["USE_WRITE_DB"] = "True"
+
+    from api.database import engine, init_db
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    maintain_storage(engine)
+
+
+if __name__ == "__main__":
+    main()
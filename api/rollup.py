@@ -0,0 +1,127 @@
+from collections import defaultdict
+from datetime import timedelta
+from pathlib import Path
+import os
+import sys
+import time
+
+from sqlalchemy import delete, func, insert, select
+
+# Start of the bucket a time falls into, and the length of the bucket
+BUCKETS = {
+    "1h": lambda row_time: row_time.replace(minute=0, second=0, microsecond=0),
+    "1d": lambda row_time: row_time.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+BUCKET_LENGTHS = {"1h": timedelta(hours=1), "1d": timedelta(days=1)}
+
+# Aggregates stored for every field, as <field>_<aggregate> columns
+AGGREGATES = ("mean", "min", "max", "last")
+
+# Raw rows read per transaction when rebuilding whole tables
+REBUILD_SPAN = timedelta(days=30)
+
+
+def summarize(rollup, group, bucket_time, rows):
+    # Rows are ordered by time, so the last one is the newest of the bucket
+    summary = {rollup.time_field: bucket_time, "count": len(rows)}
+    if rollup.group_field is not None:
+        summary[rollup.group_field] = group
+    for field in rollup.fields:
+        values = [row[field] for row in rows]
+        summary[f"{field}_mean"] = sum(values) / len(values)
+        summary[f"{field}_min"] = min(values)
+        summary[f"{field}_max"] = max(values)
+        summary[f"{field}_last"] = values[-1]
+    return summary
+
+
+def write_rollup(session, model, rollup, start_time, end_time):
+    # Recompute the buckets in [start_time, end_time) from the raw rows, which
+    # makes rewriting a bucket safe however often its rows are written
+    time_column = getattr(model, rollup.time_field)
+    groups = [getattr(model, rollup.group_field)] if rollup.group_field else []
+    rows = session.execute(
+        select(
+            *groups,
+            time_column,
+            *(getattr(model, field) for field in rollup.fields),
+        )
+        .where(time_column >= start_time, time_column < end_time)
+        .order_by(time_column, model._id)
+    ).mappings()
+
+    buckets = defaultdict(list)
+    for row in rows:
+        group = row[rollup.group_field] if rollup.group_field else None
+        buckets[group, BUCKETS[rollup.bucket](row[rollup.time_field])].append(row)
+
+    rollup_time = getattr(rollup, rollup.time_field)
+    session.execute(
+        delete(rollup).where(rollup_time >= start_time, rollup_time < end_time)
+    )
+    summaries = [
+        summarize(rollup, group, bucket_time, bucket_rows)
+        for (group, bucket_time), bucket_rows in buckets.items()
+    ]
+    if summaries:
+        session.execute(insert(rollup), summaries)
+    return len(summaries)
+
+
+def update_rollups(session, model, times):
+    # Called with the times of the rows just written, only the buckets
+    # between the oldest and the newest of them are recomputed
+    if not times:
+        return
+    session.flush()
+    for bucket, rollup in getattr(model, "rollups", {}).items():
+        write_rollup(
+            session,
+            model,
+            rollup,
+            BUCKETS[bucket](min(times)),
+            BUCKETS[bucket](max(times)) + BUCKET_LENGTHS[bucket],
+        )
+
+
+def rebuild_rollups(database, model):
+    # Fill the rollups from the whole raw table, REBUILD_SPAN at a time
+    time_column = getattr(model, next(iter(model.rollups.values())).time_field)
+    with database() as session:
+        first_time, last_time = session.execute(
+            select(func.min(time_column), func.max(time_column))
+        ).one()
+    if first_time is None:
+        return 0
+
+    count = 0
+    start_time = BUCKETS["1d"](first_time)
+    while start_time <= last_time:
+        end_time = start_time + REBUILD_SPAN
+        with database() as session:
+            for rollup in model.rollups.values():
+                count += write_rollup(session, model, rollup, start_time, end_time)
+        start_time = end_time
+    return count
+
+
+def main():
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    os.environ["USE_WRITE_DB"] = "True"
+
+    from api.database import init_db, session_maker_modify
+    from api.models import Reservoir, Electricity, Earthquake
+
+    # Rebuilds every rollup table, for history written before they existed
+    init_db()
+    for model in (Reservoir, Electricity, Earthquake):
+        started = time.perf_counter()
+        count = rebuild_rollups(session_maker_modify, model)
+        print(
+            f"{model.__tablename__} rollups: {count} rows in "
+            f"{time.perf_counter() - started:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+from collections import deque
+import random
+import statistics
+
+# Publish times kept to estimate the cadence and the delay of a source
+CADENCE_SAMPLES = 8
+# Extra delay added to every deadline, as a fraction of the delay, so the
+# replicas and managers do not hit the upstream servers in lockstep
+JITTER = 0.1
+
+
+# Decides when a manager polls its upstream next. Deadlines are absolute wall
+# clock times, so the time spent fetching never shifts the next poll.
+#
+# Sources publishing at a steady cadence are polled right after the next
+# expected publish: newest publish time + median gap between publishes + the
+# shortest delay seen between a publish and our first sight of it. Once that
+# time has passed without anything new, polls start at min_interval and slow
+# down geometrically up to max_interval. Failed polls back off the same way.
+# Until two gaps have been seen, the source is polled every interval.
+class PollSchedule:
+    def __init__(self, interval, min_interval, max_interval, jitter=JITTER, rng=None):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.publish_times = deque(maxlen=CADENCE_SAMPLES)
+        self.lags = deque(maxlen=CADENCE_SAMPLES)
+        self.misses = 0
+        self.failures = 0
+        self.deadline = None
+
+    @property
+    def cadence(self):
+        if len(self.publish_times) < 3:
+            return None
+        times = list(self.publish_times)
+        gaps = [newer - older for older, newer in zip(times, times[1:])]
+        return min(max(statistics.median(gaps), self.min_interval), self.max_interval)
+
+    @property
+    def expected_time(self):
+        # When the next publish should be visible upstream
+        if self.cadence is None:
+            return None
+        return self.publish_times[-1] + self.cadence + min(self.lags, default=0)
+
+    def backoff(self, steps):
+        return min(self.min_interval * 2 ** (steps - 1), self.max_interval)
+
+    def record(self, now, published_time=None, failed=False):
+        # Called after every poll with the newest upstream time, as a
+        # timestamp, and returns the deadline of the next poll
+        if failed:
+            self.failures += 1
+            return self.schedule(now, now + self.backoff(self.failures))
+        self.failures = 0
+
+        if published_time is not None and (
+            not self.publish_times or published_time > self.publish_times[-1]
+        ):
+            # The first publish seen may be old, it says nothing of the delay
+            if self.publish_times:
+                self.lags.append(max(now - published_time, 0))
+            self.publish_times.append(published_time)
+            self.misses = 0
+
+        expected_time = self.expected_time
+        if expected_time is None:
+            # Regular polling, on the grid of the previous deadlines
+            deadline = (self.deadline or now) + self.interval
+            while deadline <= now:
+                deadline += self.interval
+            return self.schedule(now, deadline)
+        if expected_time > now:
+            return self.schedule(now, min(expected_time, now + self.max_interval))
+        self.misses += 1
+        return self.schedule(now, now + self.backoff(self.misses))
+
+    def schedule(self, now, deadline):
+        self.deadline = deadline
+        return deadline + self.rng.uniform(0, self.jitter) * (deadline - now)
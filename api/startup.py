@@ -0,0 +1,82 @@
+from pathlib import Path
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Runs in a fresh interpreter so nothing is imported beforehand
+PROBE = """
+import resource
+import time
+
+started = time.perf_counter()
+{statement}
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def parse_importtime(lines):
+    # Lines look like "import time:   self [us] | cumulative | imported package",
+    # nested imports are indented under the module importing them
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        modules.append(
+            {
+                "name": name.strip(),
+                "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+            }
+        )
+    return modules
+
+
+def profile_startup(statement, top=15):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(statement=statement)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:], file=sys.stderr)
+        return result.returncode
+
+    wall_time, max_rss = result.stdout.split()[-2:]
+    modules = parse_importtime(result.stderr.splitlines())
+
+    packages = {}
+    for module in modules:
+        package = module["name"].split(".")[0]
+        packages[package] = packages.get(package, 0) + module["self_us"]
+
+    print(f"Startup of `{statement}`")
+    print(
+        f"wall time {float(wall_time) * 1000:.1f} ms, max RSS {int(max_rss) / 1024:.1f} MiB"
+    )
+    print(f"{len(modules)} modules, {sum(packages.values()) / 1000:.1f} ms importing")
+
+    print("\nSlowest packages (self time summed over their modules)")
+    for package, self_us in sorted(packages.items(), key=lambda x: -x[1])[:top]:
+        print(f"{self_us / 1000:>10.1f} ms  {package}")
+
+    # A module is reported after everything it imports, so the direct imports
+    # of the target are the depth 1 lines right before its own line
+    direct, children = [], []
+    for module in modules:
+        if module["depth"] == 1:
+            children.append(module)
+        elif module["depth"] == 0:
+            if module["name"] == statement.split()[-1]:
+                direct = children
+            children = []
+
+    print("\nSlowest direct imports (cumulative)")
+    for module in sorted(direct, key=lambda x: -x["cumulative_us"])[:top]:
+        print(f"{module['cumulative_us'] / 1000:>10.1f} ms  {module['name']}")
+    return 0
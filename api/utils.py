@@ -1,7 +1,15 @@
 from datetime import datetime
+from urllib.parse import urlsplit
+import asyncio
 import json
 import logging
 
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import insert, select
+
+from api import metrics
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s {%(pathname)s:%(lineno)d} %(levelname)s %(message)s",
@@ -21,30 +29,157 @@ def get_json_file(file_name):
         return json.load(f)
 
 
+# Bulk insert the rows whose key is not stored yet and return the inserted
+# rows and the number of skipped ones. Existing keys are read with one query over the
+# time span of the batch instead of one lookup per row.
+def insert_new_rows(session, model, rows, key_columns, time_column):
+    if not rows:
+        return [], 0
+
+    times = [row[time_column] for row in rows]
+    key_attrs = [getattr(model, column) for column in key_columns]
+    existing = set(
+        session.execute(
+            select(*key_attrs).where(
+                getattr(model, time_column).between(min(times), max(times))
+            )
+        ).all()
+    )
+
+    new_rows = []
+    for row in rows:
+        key = tuple(row[column] for column in key_columns)
+        if key not in existing:
+            existing.add(key)
+            new_rows.append(row)
+
+    if new_rows:
+        session.execute(insert(model), new_rows)
+    return new_rows, len(rows) - len(new_rows)
+
+
+# (connect, read) timeout in seconds for each upstream host
+HOST_TIMEOUTS = {
+    "data.wra.gov.tw": (5, 30),
+    "www.taipower.com.tw": (5, 15),
+    "opendata.cwb.gov.tw": (5, 30),
+}
+DEFAULT_TIMEOUT = (5, 30)
+
+# One pooled session shared by every manager so connections are kept alive
+# between cycles instead of re-doing the TLS handshake on each request
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=len(HOST_TIMEOUTS), pool_maxsize=4)
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+
+def http_get(url, **kwargs):
+    kwargs.setdefault(
+        "timeout", HOST_TIMEOUTS.get(urlsplit(url).hostname, DEFAULT_TIMEOUT)
+    )
+    return http_session.get(url, **kwargs)
+
+
 class Base:
-    def __init__(self, time_pattern, database, instance_cls):
+    # Label of the manager in the logs and metrics
+    name = None
+    # Upper bound in seconds for fetching all sources of one cycle
+    fetch_timeout = 60
+
+    def __init__(
+        self, time_pattern, database, instance_cls, lease=None, latest_cls=None
+    ):
         self.time_pattern = time_pattern
         self.database = database
         self.instance_cls = instance_cls
+        # Table holding only the newest row per key, upserted with the history
+        self.latest_cls = latest_cls
+        self.lease = lease
         self.logging = logging  # Force the binding
-        self.update()
+        self.failed = False
+        metrics.register(self.name)
+
+        # Standby replicas wait for the lease before fetching anything
+        if self.lease is None or self.lease.acquire():
+            self.update()
 
     def format_time(self, datetime_str):
         return datetime.strptime(datetime_str, self.time_pattern)
 
-    def update_database():
+    def fetch_sources(self):
+        # Mapping of source name to a callable returning its raw payload
+        raise NotImplementedError
+
+    def parse(self, payloads):
+        raise NotImplementedError
+
+    def update_database(self):
         raise NotImplementedError
 
+    def fetch_source(self, source, fetch):
+        with metrics.timed(
+            metrics.upstream_seconds.labels(self.name, source), self.name, "fetch"
+        ):
+            return fetch()
+
+    @property
+    def published_time(self):
+        # Newest time reported by the upstream sources, used for scheduling
+        return None
+
+    def record_error(self, stage):
+        # The scheduler backs off while cycles keep failing
+        self.failed = True
+        metrics.errors_total.labels(self.name, stage).inc()
+
+    def fetch(self):
+        self.failed = False
+        return {
+            source: self.fetch_source(source, fetch)
+            for source, fetch in self.fetch_sources().items()
+        }
+
+    def count_rows(self, inserted, skipped):
+        # Called by update_database once a cycle has been committed
+        metrics.rows_total.labels(self.name, "inserted").inc(inserted)
+        metrics.rows_total.labels(self.name, "skipped").inc(skipped)
+        metrics.mark_updated(self.name)
+
+    def update_func(self):
+        self.parse(self.fetch())
+
+    def process(self, payloads):
+        with metrics.timed(metrics.parse_seconds.labels(self.name), self.name, "parse"):
+            self.parse(payloads)
+        # The lease may have been lost to another replica while fetching
+        if self.lease is not None and not self.lease.held:
+            logging.warning(f"Skip writing {self.lease.resource} data without lease")
+            return
+        with metrics.timed(metrics.write_seconds.labels(self.name), self.name, "write"):
+            self.update_database()
+        logging.info(f"Update {self.name} data")
+
     def update(self):
-        self.update_func()
-        self.update_database()
-        logging.info(
-            f"Update {self.__class__.__name__.replace('Manager', '').lower()} data"
+        self.process(self.fetch())
+
+    async def update_async(self, loop, io_executor, work_executor):
+        # Sources are fetched concurrently, parsing and writing run off the loop
+        sources = self.fetch_sources()
+        self.failed = False
+        payloads = await asyncio.wait_for(
+            asyncio.gather(
+                *(
+                    loop.run_in_executor(io_executor, self.fetch_source, source, fetch)
+                    for source, fetch in sources.items()
+                )
+            ),
+            timeout=self.fetch_timeout,
+        )
+        await loop.run_in_executor(
+            work_executor, self.process, dict(zip(sources.keys(), payloads))
         )
 
     @property
     def last_updated_time(self):
         return datetime.strftime(self.updated_time, "%Y-%m-%d %H:%M:%S")
-
-
-county_data = get_json_file("county_data.json")
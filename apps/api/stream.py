@@ -0,0 +1,202 @@
+from collections import deque
+import json
+import logging
+import threading
+import time
+from flask import Blueprint, current_app, request, stream_with_context
+from prometheus_client import Gauge
+from sqlalchemy import select
+from api.models import Earthquake
+from api.database import session_maker_readonly
+from apps.api.views import get_data_version, process_electricity, process_reservoir
+
+# Served by its own gunicorn service with gevent workers, see
+# apps/stream_gunicorn_config.py: every client waits on an open connection,
+# which would hold one of the few threads of the gthread workers of the API.
+
+# Seconds between two checks for new rows, shared by every client of a
+# worker, between two keep-alive comments, and before a client is asked to
+# reconnect, which spreads the clients over the workers again
+STREAM_POLL_INTERVAL = 2
+STREAM_HEARTBEAT = 15
+STREAM_MAX_AGE = 300
+STREAM_RETRY_MS = 3000
+# Events kept for clients resuming with Last-Event-ID, and new earthquake
+# rows sent in one event at most
+STREAM_BACKLOG = 256
+STREAM_EARTHQUAKE_LIMIT = 100
+
+stream_clients = Gauge("stream_clients", "Clients connected to /stream")
+
+
+def get_new_earthquakes(last_id, newest_id):
+    # At most STREAM_EARTHQUAKE_LIMIT rows after last_id, with the _id of the
+    # last one, the next event starts after it
+    with session_maker_readonly() as db:
+        earthquakes = (
+            db.execute(
+                select(Earthquake)
+                .where(Earthquake._id > last_id, Earthquake._id <= newest_id)
+                .order_by(Earthquake._id)
+                .limit(STREAM_EARTHQUAKE_LIMIT)
+            )
+            .scalars()
+            .all()
+        )
+        return earthquakes[-1]._id if earthquakes else newest_id, [
+            {
+                "area": earthquake.area,
+                "source": earthquake.source,
+                "number": earthquake.number,
+                "pga": earthquake.pga,
+                "pgv": earthquake.pgv,
+                "observed_time": earthquake.observed_time.strftime(
+                    r"%Y-%m-%d %H:%M:%S"
+                ),
+            }
+            for earthquake in earthquakes
+        ]
+
+
+# Newest primary key of each table, in the order of get_data_version, and
+# the newest primary key and data sent when it grows
+CHANGE_FEEDS = (
+    ("reservoir", lambda last_id, newest_id: (newest_id, process_reservoir())),
+    ("electricity", lambda last_id, newest_id: (newest_id, process_electricity())),
+    ("earthquake", get_new_earthquakes),
+)
+
+
+def format_version(version):
+    return "-".join(str(row_id) for row_id in version)
+
+
+def parse_version(event_id):
+    try:
+        version = tuple(int(row_id) for row_id in event_id.split("-"))
+    except (AttributeError, ValueError):
+        return None
+    return version if len(version) == len(CHANGE_FEEDS) else None
+
+
+# One per worker: a single thread, a greenlet under gevent, checks for new rows every poll_interval and
+# wakes the clients of /stream, so the database load does not grow with them.
+# Events are identified by the newest primary keys, which every worker agrees
+# on, so a client can resume on another worker with Last-Event-ID.
+class ChangeDetector:
+    def __init__(self, poll_interval=STREAM_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.version = None
+        self.events = deque(maxlen=STREAM_BACKLOG)
+        self.subscribers = 0
+        self.thread = None
+
+    def start(self):
+        # Threads do not survive the fork, so it starts in the worker with its
+        # first client, once the current version is known
+        if self.thread is not None:
+            return
+        self.poll()
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="change-detector", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while True:
+            # Idle, without querying, while nobody listens
+            with self.condition:
+                self.condition.wait_for(lambda: self.subscribers > 0)
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Failed to check for new rows")
+
+    def poll(self):
+        version = tuple(row_id or 0 for row_id in get_data_version())
+        previous = self.version
+        events = []
+        if previous is not None:
+            # Each event id only covers the rows sent so far, a client resuming
+            # from it gets the rest, a feed sends events until caught up
+            sent = list(previous)
+            for index, (resource, get_data) in enumerate(CHANGE_FEEDS):
+                while sent[index] < version[index]:
+                    sent[index], rows = get_data(sent[index], version[index])
+                    data = json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+                    events.append((tuple(sent), index, resource, data))
+
+        with self.condition:
+            self.version = version
+            self.events.extend(events)
+            self.condition.notify_all()
+
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+            return self.version
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def newer(self, seen):
+        return [event for event in self.events if event[0][event[1]] > seen[event[1]]]
+
+    def wait(self, seen, timeout):
+        # Events after the seen version, waiting up to timeout for one
+        with self.condition:
+            self.condition.wait_for(lambda: self.newer(seen), timeout)
+            events = self.newer(seen)
+            return events, tuple(map(max, seen, self.version))
+
+
+change_detector = ChangeDetector()
+
+
+def stream_events(detector, seen=None, max_age=STREAM_MAX_AGE):
+    version = detector.subscribe()
+    seen = seen or version
+    stream_clients.inc()
+    started = time.monotonic()
+    try:
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        while time.monotonic() - started < max_age:
+            events, seen = detector.wait(seen, STREAM_HEARTBEAT)
+            if not events:
+                # Also how a disconnected client is noticed
+                yield ": keep-alive\n\n"
+            for event_version, _, resource, data in events:
+                yield (
+                    f"id: {format_version(event_version)}\n"
+                    f"event: {resource}\ndata: {data}\n\n"
+                )
+    finally:
+        stream_clients.dec()
+        detector.unsubscribe()
+
+
+stream_api = Blueprint("stream", __name__)
+
+
+@stream_api.route("/stream")
+def stream():
+    # Server-Sent Events: reservoir and electricity events carry the latest
+    # rows like the index, earthquake events the new earthquake rows
+    change_detector.start()
+    response = current_app.response_class(
+        stream_with_context(
+            stream_events(
+                change_detector, parse_version(request.headers.get("Last-Event-ID"))
+            )
+        ),
+        mimetype="text/event-stream",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    # Sent as they come instead of buffered by a reverse proxy
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
@@ -1,8 +1,73 @@
+import base64
 import datetime
-from flask import Blueprint, jsonify, request
-from sqlalchemy import desc
-from api.models import Reservoir, Electricity, Earthquake
+import gzip
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+import zlib
+from urllib.parse import urlencode
+from flask import Blueprint, abort, current_app, request, stream_with_context
+from prometheus_client import Counter
+from sqlalchemy import and_, desc, func, or_, select
+from api.models import (
+    Reservoir,
+    ReservoirReading,
+    Electricity,
+    Earthquake,
+    LatestReservoir,
+    LatestElectricity,
+)
 from api.database import session_maker_readonly
+from api.regions import get_regions
+from api.retention import read_archive, read_archive_groups
+from api.rollup import AGGREGATES, BUCKETS
+
+# The index is rebuilt when a table gets new rows, and at least every
+# INDEX_CACHE_MAX_AGE seconds so the 30-day earthquake window keeps sliding
+INDEX_CACHE_MAX_AGE = 300
+
+# Rows fetched per round trip when streaming the time-range endpoints
+STREAM_BATCH_SIZE = 1000
+# Largest page a client can ask for with ?limit=
+MAX_PAGE_LIMIT = 10000
+# Smaller bodies are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+RESERVOIR_FIELDS = (
+    "inflow",
+    "outflow",
+    "total_capacity",
+    "current_capacity",
+    "percentage",
+)
+ELECTRICITY_FIELDS = (
+    "north_generate",
+    "north_usage",
+    "central_generate",
+    "central_usage",
+    "south_generate",
+    "south_usage",
+)
+EARTHQUAKE_FIELDS = ("source", "pga", "pgv")
+
+# bucket=auto reads hourly rollups up to this span and daily ones beyond it
+AUTO_HOURLY_SPAN = datetime.timedelta(days=31)
+
+index_cache = {
+    "version": None,
+    "created_time": 0.0,
+    "body": None,
+    "gzip_body": None,
+    "etag": None,
+}
+index_cache_lock = threading.Lock()
+index_cache_requests = Counter(
+    "index_cache_requests_total",
+    "Requests of the index served from the cache or rebuilt",
+    ["result"],
+)
 
 
 def process_time(start_time, end_time):
@@ -16,40 +81,86 @@ def process_time(start_time, end_time):
     return start_time, end_time
 
 
+def process_bucket(bucket, agg, default_agg, start_time, end_time):
+    if bucket is None:
+        return None, None
+    agg = agg or default_agg
+    if (bucket != "auto" and bucket not in BUCKETS) or agg not in AGGREGATES:
+        abort(
+            400,
+            f"bucket must be one of auto, {', '.join(BUCKETS)} and "
+            f"agg one of {', '.join(AGGREGATES)}",
+        )
+    if bucket == "auto":
+        bucket = "1h" if end_time - start_time <= AUTO_HOURLY_SPAN else "1d"
+    return bucket, agg
+
+
+def encode_cursor(row_time, row_id):
+    return base64.urlsafe_b64encode(
+        f"{row_time:%Y-%m-%d %H:%M:%S.%f}|{row_id}".encode()
+    ).decode()
+
+
+def decode_cursor(cursor):
+    row_time, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.datetime.strptime(row_time, "%Y-%m-%d %H:%M:%S.%f"), int(row_id)
+
+
+def process_page(limit, cursor, bucket):
+    if limit is None:
+        if cursor is not None:
+            abort(400, "cursor requires limit")
+        return None
+    if bucket is not None:
+        abort(400, "limit cannot be combined with bucket")
+
+    try:
+        limit = int(limit)
+        cursor = decode_cursor(cursor) if cursor else None
+    except (ValueError, UnicodeDecodeError):
+        abort(400, "invalid limit or cursor")
+    if not 0 < limit <= MAX_PAGE_LIMIT:
+        abort(400, f"limit must be between 1 and {MAX_PAGE_LIMIT}")
+    return limit, cursor
+
+
 def process_reservoir():
-    areas = ["新竹", "臺中", "臺南"]
-    data = {}
+    areas = get_regions().reservoir_areas
 
+    # One primary key lookup for every area, on the table the fetcher keeps
+    # one row per area in
     with session_maker_readonly() as db:
-        for area in areas:
-            reservoir_data = (
-                db.query(Reservoir)
-                .filter_by(area=area)
-                .order_by(desc(Reservoir.updated_time))
-                .first()
+        latest = {
+            reservoir_data.area: reservoir_data
+            for reservoir_data in db.query(LatestReservoir).filter(
+                LatestReservoir.area.in_(areas)
             )
-            if reservoir_data is None:
-                data[area] = {}
-            else:
-                data[area] = {
-                    "inflow": reservoir_data.inflow,
-                    "outflow": reservoir_data.outflow,
-                    "total_capacity": reservoir_data.total_capacity,
-                    "current_capacity": reservoir_data.current_capacity,
-                    "percentage": reservoir_data.percentage,
-                    "updated_time": reservoir_data.updated_time.strftime(
-                        r"%Y-%m-%d %H:%M:%S"
-                    ),
-                }
+        }
+
+    data = {}
+    for area in areas:
+        reservoir_data = latest.get(area)
+        if reservoir_data is None:
+            data[area] = {}
+        else:
+            data[area] = {
+                "inflow": reservoir_data.inflow,
+                "outflow": reservoir_data.outflow,
+                "total_capacity": reservoir_data.total_capacity,
+                "current_capacity": reservoir_data.current_capacity,
+                "percentage": reservoir_data.percentage,
+                "updated_time": reservoir_data.updated_time.strftime(
+                    r"%Y-%m-%d %H:%M:%S"
+                ),
+            }
 
     return data
 
 
 def process_electricity():
     with session_maker_readonly() as db:
-        electricity_data = (
-            db.query(Electricity).order_by(desc(Electricity.updated_time)).first()
-        )
+        electricity_data = db.get(LatestElectricity, "electricity")
         if electricity_data is None:
             return {}
         else:
@@ -67,102 +178,439 @@ def process_electricity():
 
 
 def process_earthquake():
-    data = {"新竹": [], "臺中": [], "臺南": []}
-    current_time = datetime.datetime.now()
+    areas = get_regions().earthquake_areas
+    data = {area: [] for area in areas}
+    start_time = datetime.datetime.now() - datetime.timedelta(days=30)
 
+    # Only the last 30 days are read, through the observed_time index, in a
+    # single query for every area
     with session_maker_readonly() as db:
         earthquakes = (
-            db.query(Earthquake).order_by(desc(Earthquake.observed_time)).all()
+            db.query(Earthquake)
+            .filter(Earthquake.observed_time >= start_time, Earthquake.area.in_(areas))
+            .order_by(desc(Earthquake.observed_time))
         )
         for earthquake in earthquakes:
-            data_time = earthquake.observed_time
-            if current_time - data_time > datetime.timedelta(days=30):
-                break
             data[earthquake.area].append(
                 {
                     "source": earthquake.source,
                     "pga": earthquake.pga,
                     "pgv": earthquake.pgv,
-                    "observed_time": data_time.strftime(r"%Y-%m-%d %H:%M:%S"),
+                    "observed_time": earthquake.observed_time.strftime(
+                        r"%Y-%m-%d %H:%M:%S"
+                    ),
                 }
             )
         return data
 
 
-def get_reservoir_with_time_range(start_time, end_time):
-    areas = ["新竹", "臺中", "臺南"]
-    data = {}
-
+def get_data_version():
+    # Newest primary key of every table, in a single round trip
     with session_maker_readonly() as db:
-        reservoir_range_data = db.query(Reservoir).filter(
-            Reservoir.updated_time.between(start_time, end_time)
+        return tuple(
+            db.execute(
+                select(
+                    select(func.max(Reservoir._id)).scalar_subquery(),
+                    select(func.max(Electricity._id)).scalar_subquery(),
+                    select(func.max(Earthquake._id)).scalar_subquery(),
+                )
+            ).one()
         )
 
-        for area in areas:
-            reservoir_range_data_within_area = reservoir_range_data.filter_by(
-                area=area
-            ).all()
-            data[area] = []
-            for reservoir_data in reservoir_range_data_within_area:
-                data[area].append(
-                    {
-                        "inflow": reservoir_data.inflow,
-                        "outflow": reservoir_data.outflow,
-                        "total_capacity": reservoir_data.total_capacity,
-                        "current_capacity": reservoir_data.current_capacity,
-                        "percentage": reservoir_data.percentage,
-                        "updated_time": reservoir_data.updated_time.strftime(
-                            r"%Y-%m-%d %H:%M:%S"
-                        ),
-                    }
+
+def get_range_version(model, time_field, start_time, end_time):
+    # Newest time, row count and newest _id of a range, read from the time
+    # index only, which carries the primary key. A row replaced in place
+    # gets a new _id, so it changes the version too.
+    time_column = getattr(model, time_field)
+    with session_maker_readonly() as db:
+        return tuple(
+            db.execute(
+                select(func.max(time_column), func.count(), func.max(model._id)).where(
+                    time_column.between(start_time, end_time)
                 )
-    return data
+            ).one()
+        )
 
 
-def get_electricity_with_time_range(start_time, end_time):
-    data = []
+def get_cached_index(version):
+    with index_cache_lock:
+        if (
+            index_cache["version"] == version
+            and time.monotonic() - index_cache["created_time"] < INDEX_CACHE_MAX_AGE
+        ):
+            index_cache_requests.labels("hit").inc()
+            return dict(index_cache)
 
-    with session_maker_readonly() as db:
-        electricity_range_data = db.query(Electricity).filter(
-            Electricity.updated_time.between(start_time, end_time)
+    index_cache_requests.labels("miss").inc()
+    all_data = {
+        resource_name: resource_func()
+        for resource_name, resource_func in resources.items()
+    }
+    body = current_app.json.response(all_data).get_data()
+    entry = {
+        "version": version,
+        "created_time": time.monotonic(),
+        "body": body,
+        "gzip_body": gzip.compress(body) if len(body) >= GZIP_MIN_SIZE else None,
+        "etag": hashlib.sha1(body).hexdigest(),
+    }
+    with index_cache_lock:
+        index_cache.update(entry)
+    return entry
+
+
+def accepts_gzip():
+    return request.accept_encodings["gzip"] > 0
+
+
+def is_not_modified(etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return (
+            last_modified.replace(microsecond=0).astimezone(datetime.timezone.utc)
+            <= request.if_modified_since
         )
+    return False
+
+
+def representation_etag(etag, gzipped):
+    # The gzip body is another representation, a strong validator of its own
+    return f"{etag}-gzip" if gzipped else etag
 
-        for electricity_data in electricity_range_data:
-            data.append(
-                {
-                    "north_generate": electricity_data.north_generate,
-                    "north_usage": electricity_data.north_usage,
-                    "central_generate": electricity_data.central_generate,
-                    "central_usage": electricity_data.central_usage,
-                    "south_generate": electricity_data.south_generate,
-                    "south_usage": electricity_data.south_usage,
-                    "updated_time": electricity_data.updated_time.strftime(
-                        r"%Y-%m-%d %H:%M:%S"
-                    ),
-                }
-            )
 
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.astimezone(datetime.timezone.utc)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def not_modified_response(etag, last_modified):
+    return set_validators(current_app.response_class(status=304), etag, last_modified)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        # An empty chunk would end a chunked response early
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def format_row(row, fields, time_field):
+    data = {field: row[field] for field in fields}
+    data[time_field] = row[time_field].strftime(r"%Y-%m-%d %H:%M:%S")
     return data
 
 
-def get_earthquake_with_time_range(start_time, end_time):
-    data = {"新竹": [], "臺中": [], "臺南": []}
+def stream_list(rows, fields, time_field):
+    # Serialize rows one by one so only a batch of them is held in memory
+    dumps = current_app.json.dumps
+    yield "["
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + dumps(format_row(row, fields, time_field))
+    yield "]"
+
+
+def stream_groups(rows, group_field, groups, fields, time_field):
+    # Rows must be ordered by group_field, groups without rows are sent empty
+    dumps = current_app.json.dumps
+    yield "{"
+    sent_groups = []
+    for group, group_rows in itertools.groupby(rows, key=lambda row: row[group_field]):
+        yield ("," if sent_groups else "") + dumps(group) + ":"
+        yield from stream_list(group_rows, fields, time_field)
+        sent_groups.append(group)
+    for group in groups:
+        if group not in sent_groups:
+            yield ("," if sent_groups else "") + dumps(group) + ":[]"
+            sent_groups.append(group)
+    yield "}"
+
+
+def stream_query(query):
+    # Server-side cursor fetching STREAM_BATCH_SIZE rows at a time
     with session_maker_readonly() as db:
-        earthquake_range_data = db.query(Earthquake).filter(
-            Earthquake.observed_time.between(start_time, end_time)
+        for row in db.execute(
+            query.execution_options(yield_per=STREAM_BATCH_SIZE)
+        ).mappings():
+            yield row
+
+
+def rollup_query(model, bucket, agg, start_time, end_time):
+    # One precomputed row per group and bucket, with the bucket start as time
+    rollup = model.rollups[bucket]
+    time_column = getattr(rollup, rollup.time_field)
+    groups = [getattr(rollup, rollup.group_field)] if rollup.group_field else []
+    return (
+        select(
+            *groups,
+            *(
+                getattr(rollup, f"{field}_{agg}").label(field)
+                for field in rollup.fields
+            ),
+            rollup.count,
+            time_column,
         )
-        for earthquake in earthquake_range_data:
-            data[earthquake.area].append(
-                {
-                    "source": earthquake.source,
-                    "pga": earthquake.pga,
-                    "pgv": earthquake.pgv,
-                    "observed_time": earthquake.observed_time.strftime(
-                        r"%Y-%m-%d %H:%M:%S"
-                    ),
-                }
+        .where(time_column.between(start_time, end_time))
+        .order_by(*groups, time_column)
+    )
+
+
+def range_query(
+    model,
+    time_field,
+    fields,
+    start_time,
+    end_time,
+    group_field=None,
+    page=None,
+    match=None,
+):
+    # match maps columns to the only value their rows may have
+    time_column = getattr(model, time_field)
+    groups = [getattr(model, group_field)] if group_field else []
+    query = select(
+        model._id,
+        *groups,
+        *(getattr(model, field) for field in fields),
+        time_column,
+    ).where(
+        time_column.between(start_time, end_time),
+        *(getattr(model, column) == value for column, value in (match or {}).items()),
+    )
+    if page is None:
+        return query.order_by(*groups, time_column, model._id)
+
+    # Seek past the cursor on (time, _id); the secondary index on the time
+    # column already carries the primary key, so no extra index is needed
+    limit, cursor = page
+    if cursor is not None:
+        cursor_time, cursor_id = cursor
+        query = query.where(
+            or_(
+                time_column > cursor_time,
+                and_(time_column == cursor_time, model._id > cursor_id),
             )
-    return data
+        )
+    return query.order_by(time_column, model._id).limit(limit + 1)
+
+
+def row_key(time_field, group_field=None):
+    # Order of range_query, which archived rows are merged in
+    if group_field is None:
+        return lambda row: (row[time_field], row["_id"])
+    return lambda row: (row[group_field], row[time_field], row["_id"])
+
+
+def archive_rows(
+    model, time_field, fields, start_time, end_time, group_field, page, match=None
+):
+    # Rows of the months moved out of the database, filtered and ordered like
+    # range_query would have returned them, None when no month is archived.
+    # A page reads at most one row past its limit, in time order like the
+    # archives, unpaged groups are read one group after the other.
+    limit, cursor = page or (None, None)
+    columns = ("_id", *([group_field] if group_field else []), *fields, time_field)
+    if page is None and group_field is not None:
+        return read_archive_groups(
+            model.__tablename__,
+            columns,
+            time_field,
+            group_field,
+            start_time,
+            end_time,
+            match=match,
+        )
+
+    rows = read_archive(
+        model.__tablename__,
+        columns,
+        time_field,
+        start_time,
+        end_time,
+        match=match,
+        after=cursor,
+    )
+    if rows is None or page is None:
+        return rows
+    return list(itertools.islice(rows, limit + 1))
+
+
+def merge_rows(archived, rows, key):
+    # A month being archived can briefly be in both places, send it once
+    last_key = None
+    for row in heapq.merge(archived, rows, key=key):
+        if key(row) != last_key:
+            last_key = key(row)
+            yield row
+
+
+def fetch_range(
+    model,
+    time_field,
+    fields,
+    start_time,
+    end_time,
+    group_field=None,
+    page=None,
+    match=None,
+):
+    # Returns the rows and the cursor of the next page, if there is one
+    rows = stream_query(
+        range_query(
+            model, time_field, fields, start_time, end_time, group_field, page, match
+        )
+    )
+    archived = archive_rows(
+        model, time_field, fields, start_time, end_time, group_field, page, match
+    )
+    if archived is not None:
+        rows = merge_rows(
+            archived, rows, row_key(time_field, None if page else group_field)
+        )
+    if page is None:
+        return rows, None
+
+    limit = page[0]
+    rows = list(rows)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][time_field], rows[-1]["_id"])
+    if group_field is not None:
+        rows.sort(key=lambda row: row[group_field])
+    return rows, next_cursor
+
+
+def get_reservoir_with_time_range(
+    start_time, end_time, bucket=None, agg=None, page=None
+):
+    areas = get_regions().reservoir_areas
+    if bucket is not None:
+        query = rollup_query(Reservoir, bucket, agg, start_time, end_time)
+        return (
+            stream_groups(
+                stream_query(query),
+                "area",
+                areas,
+                RESERVOIR_FIELDS + ("count",),
+                "updated_time",
+            ),
+            None,
+        )
+
+    rows, next_cursor = fetch_range(
+        Reservoir, "updated_time", RESERVOIR_FIELDS, start_time, end_time, "area", page
+    )
+    return (
+        stream_groups(rows, "area", areas, RESERVOIR_FIELDS, "updated_time"),
+        next_cursor,
+    )
+
+
+def get_reservoir_readings(reservoir_id, start_time, end_time, page=None):
+    rows, next_cursor = fetch_range(
+        ReservoirReading,
+        "observed_time",
+        RESERVOIR_FIELDS,
+        start_time,
+        end_time,
+        page=page,
+        match={"reservoir_id": reservoir_id},
+    )
+    return stream_list(rows, RESERVOIR_FIELDS, "observed_time"), next_cursor
+
+
+def get_electricity_with_time_range(
+    start_time, end_time, bucket=None, agg=None, page=None
+):
+    if bucket is not None:
+        query = rollup_query(Electricity, bucket, agg, start_time, end_time)
+        return (
+            stream_list(
+                stream_query(query), ELECTRICITY_FIELDS + ("count",), "updated_time"
+            ),
+            None,
+        )
+
+    rows, next_cursor = fetch_range(
+        Electricity, "updated_time", ELECTRICITY_FIELDS, start_time, end_time, page=page
+    )
+    return stream_list(rows, ELECTRICITY_FIELDS, "updated_time"), next_cursor
+
+
+def get_earthquake_with_time_range(
+    start_time, end_time, bucket=None, agg=None, page=None
+):
+    areas = get_regions().earthquake_areas
+    if bucket is not None:
+        query = rollup_query(Earthquake, bucket, agg, start_time, end_time)
+        return (
+            stream_groups(
+                stream_query(query),
+                "area",
+                areas,
+                Earthquake.rollups[bucket].fields + ("count",),
+                "observed_time",
+            ),
+            None,
+        )
+
+    rows, next_cursor = fetch_range(
+        Earthquake,
+        "observed_time",
+        EARTHQUAKE_FIELDS,
+        start_time,
+        end_time,
+        "area",
+        page,
+    )
+    return (
+        stream_groups(rows, "area", areas, EARTHQUAKE_FIELDS, "observed_time"),
+        next_cursor,
+    )
+
+
+def stream_response(chunks, next_cursor=None):
+    # Streamed bodies have no known size, so they are compressed whenever the
+    # client accepts it
+    if accepts_gzip():
+        chunks = gzip_chunks(chunks)
+    response = current_app.response_class(
+        stream_with_context(chunks), mimetype=current_app.json.mimetype
+    )
+    if accepts_gzip():
+        response.content_encoding = "gzip"
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+        next_args = request.args.copy()
+        next_args["cursor"] = next_cursor
+        next_url = f"{request.base_url}?{urlencode(list(next_args.items(multi=True)))}"
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+def range_response(model, time_field, start_time, end_time, get_range):
+    # Only the newest time and the row count are read before answering 304
+    last_modified, count, last_id = get_range_version(
+        model, time_field, start_time, end_time
+    )
+    etag = representation_etag(
+        hashlib.sha1(
+            f"{request.full_path}|{last_modified}|{count}|{last_id}".encode()
+        ).hexdigest(),
+        accepts_gzip(),
+    )
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    return set_validators(stream_response(*get_range()), etag, last_modified)
 
 
 api = Blueprint("api", __name__)
@@ -178,7 +626,37 @@ def reservoir():
     start_time, end_time = process_time(
         request.args.get("start"), request.args.get("end")
     )
-    return jsonify(get_reservoir_with_time_range(start_time, end_time))
+    bucket, agg = process_bucket(
+        request.args.get("bucket"),
+        request.args.get("agg"),
+        "mean",
+        start_time,
+        end_time,
+    )
+    page = process_page(request.args.get("limit"), request.args.get("cursor"), bucket)
+    return range_response(
+        Reservoir,
+        "updated_time",
+        start_time,
+        end_time,
+        lambda: get_reservoir_with_time_range(start_time, end_time, bucket, agg, page),
+    )
+
+
+@api.route("/reservoir/<reservoir_id>")
+def reservoir_readings(reservoir_id):
+    # Readings of a single reservoir, /reservoir sums them by county
+    start_time, end_time = process_time(
+        request.args.get("start"), request.args.get("end")
+    )
+    page = process_page(request.args.get("limit"), request.args.get("cursor"), None)
+    return range_response(
+        ReservoirReading,
+        "observed_time",
+        start_time,
+        end_time,
+        lambda: get_reservoir_readings(reservoir_id, start_time, end_time, page),
+    )
 
 
 @api.route("/electricity")
@@ -186,7 +664,23 @@ def electricity():
     start_time, end_time = process_time(
         request.args.get("start"), request.args.get("end")
     )
-    return jsonify(get_electricity_with_time_range(start_time, end_time))
+    bucket, agg = process_bucket(
+        request.args.get("bucket"),
+        request.args.get("agg"),
+        "mean",
+        start_time,
+        end_time,
+    )
+    page = process_page(request.args.get("limit"), request.args.get("cursor"), bucket)
+    return range_response(
+        Electricity,
+        "updated_time",
+        start_time,
+        end_time,
+        lambda: get_electricity_with_time_range(
+            start_time, end_time, bucket, agg, page
+        ),
+    )
 
 
 @api.route("/earthquake")
@@ -194,13 +688,39 @@ def earthquake():
     start_time, end_time = process_time(
         request.args.get("start"), request.args.get("end")
     )
-    return jsonify(get_earthquake_with_time_range(start_time, end_time))
+    bucket, agg = process_bucket(
+        request.args.get("bucket"),
+        request.args.get("agg"),
+        "max",
+        start_time,
+        end_time,
+    )
+    page = process_page(request.args.get("limit"), request.args.get("cursor"), bucket)
+    return range_response(
+        Earthquake,
+        "observed_time",
+        start_time,
+        end_time,
+        lambda: get_earthquake_with_time_range(start_time, end_time, bucket, agg, page),
+    )
 
 
 @api.route("/")
 def index():
-    all_data = {
-        resource_name: resource_func()
-        for resource_name, resource_func in resources.items()
-    }
-    return jsonify(all_data)
+    # Served from the cache unless a table got new rows, so a matching
+    # validator is answered without running the resource queries. There is
+    # no Last-Modified: the body also changes when earthquakes leave the
+    # 30-day window, which no row time tells.
+    entry = get_cached_index(get_data_version())
+    gzipped = entry["gzip_body"] is not None and accepts_gzip()
+    etag = representation_etag(entry["etag"], gzipped)
+    if is_not_modified(etag, None):
+        return not_modified_response(etag, None)
+
+    response = current_app.response_class(mimetype=current_app.json.mimetype)
+    if gzipped:
+        response.set_data(entry["gzip_body"])
+        response.content_encoding = "gzip"
+    else:
+        response.set_data(entry["body"])
+    return set_validators(response, etag, None)
@@ -4,16 +4,22 @@ from api.database import DBSession
 from apps.config import config
 
 
-def create_app(config_key="local"):
+def create_app(config_key="local", streaming=False):
     app = Flask(__name__, static_folder=None)
     app.config.from_object(config[config_key])
     metrics = PrometheusMetrics(app)
     metrics.info("app_info", "Application Info", verion=1.0)
 
-    # Create blueprint from api template
-    from apps.api import views as api_view
+    if streaming:
+        # Only /stream, for the gevent workers of the stream service
+        from apps.api import stream as stream_view
 
-    app.register_blueprint(api_view.api)
+        app.register_blueprint(stream_view.stream_api)
+    else:
+        # Create blueprint from api template
+        from apps.api import views as api_view
+
+        app.register_blueprint(api_view.api)
 
     @app.teardown_appcontext
     def shutdown_session(exception=None):
@@ -15,3 +15,14 @@ threads = 4
 os.makedirs("logs/gunicorn", exist_ok=True)
 errorlog = accesslog = "logs/gunicorn/dev.log"
 access_log_format = "%(h)s %(l)s %(u)s %(t)s '%(r)s' %(s)s %(b)s '%(f)s' '%(a)s'"
+
+# Import the app once in the master, workers fork with it already loaded and
+# share its memory pages instead of each importing the whole stack again
+preload_app = True
+
+
+def post_fork(server, worker):
+    from api.database import dispose_engines
+
+    # Connections opened before the fork must not be shared with the workers
+    dispose_engines(close=False)
@@ -0,0 +1,24 @@
+import os
+import dotenv
+
+dotenv.load_dotenv(".env")
+
+# /stream only. A client holds its connection for minutes, gevent workers wait
+# on thousands of them at once where the gthread workers of the API would
+# have every thread taken by a few dashboards. The port is fixed, nginx/app.conf
+# proxies /stream to stream:5001.
+bind = "0.0.0.0:5001"
+workers = 2
+worker_class = "gevent"
+worker_connections = int(os.environ.get("STREAM_WORKER_CONNECTIONS", 2000))
+timeout = 30
+worker_tmp_dir = "/dev/shm"
+
+# Log information
+os.makedirs("logs/gunicorn", exist_ok=True)
+errorlog = accesslog = "logs/gunicorn/stream.log"
+access_log_format = "%(h)s %(l)s %(u)s %(t)s '%(r)s' %(s)s %(b)s '%(f)s' '%(a)s'"
+
+# Not preloaded: the workers patch the standard library for gevent before
+# importing the app, so its database connections and the change detector
+# thread are cooperative
@@ -0,0 +1,4 @@
+from apps.app import create_app
+
+# Entry point of the stream service, the API itself is apps.wsgi
+app = create_app(streaming=True)
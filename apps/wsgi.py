@@ -1,3 +1,19 @@
 from apps.app import create_app
 
 app = create_app()
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from api.startup import profile_startup
+
+    parser = argparse.ArgumentParser(description="WSGI entry point of the API")
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print where the boot time of a web worker goes and exit",
+    )
+    if parser.parse_args().profile_startup:
+        sys.exit(profile_startup("import apps.wsgi"))
+    parser.print_usage()
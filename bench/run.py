@@ -0,0 +1,380 @@
+from pathlib import Path
+import argparse
+import datetime
+import functools
+import http.server
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.append(ROOT.__str__())
+
+# Newest row of the synthetic tables, the ranges requested end on this day
+END_TIME = datetime.datetime(2023, 5, 1)
+
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves the recorded upstream payloads, query strings are ignored
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server():
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(FixtureHandler, directory=FIXTURES.__str__()),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def measure(func, repeat, max_seconds, setup=None):
+    # setup runs before every call of func and is not timed
+    setup = setup or (lambda: None)
+    setup()
+    func()  # Warm up caches and connections
+
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat and (
+        len(timings) < 3 or time.perf_counter() - started < max_seconds
+    ):
+        setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "runs": len(timings),
+        "ops_per_sec": len(timings) / sum(timings),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def bench_managers(base_url, args):
+    from sqlalchemy import delete
+    from api.database import session_maker_modify
+    from api.manager import ReservoirManager, ElectricityManager, EarthquakeManager
+    from api.models import (
+        Reservoir,
+        ReservoirReading,
+        Electricity,
+        Earthquake,
+        LatestReservoir,
+        LatestElectricity,
+    )
+
+    class FixtureReservoirManager(ReservoirManager):
+        reservoir_overall_url = f"{base_url}/reservoir_overall.json"
+        reservoir_detail_url = f"{base_url}/reservoir_details.json"
+
+    class FixtureElectricityManager(ElectricityManager):
+        gen_use_url = f"{base_url}/genloadareaperc.csv"
+
+    class FixtureEarthquakeManager(EarthquakeManager):
+        large_url = f"{base_url}/earthquake_large.json"
+        small_url = f"{base_url}/earthquake_small.json"
+
+    managers = {
+        "reservoir": FixtureReservoirManager(
+            session_maker_modify,
+            Reservoir,
+            latest_cls=LatestReservoir,
+            reading_cls=ReservoirReading,
+        ),
+        "electricity": FixtureElectricityManager(
+            session_maker_modify, Electricity, latest_cls=LatestElectricity
+        ),
+        "earthquake": FixtureEarthquakeManager(session_maker_modify, Earthquake),
+    }
+
+    def reset(manager):
+        # Empty tables and a manager that has ingested nothing, so every
+        # timed run parses and writes the whole recorded payload again
+        with session_maker_modify() as db:
+            for model in (
+                manager.instance_cls,
+                getattr(manager, "reading_cls", None),
+                manager.latest_cls,
+                *manager.instance_cls.rollups.values(),
+            ):
+                if model is not None:
+                    db.execute(delete(model))
+        manager.rows = []
+        if isinstance(manager, ReservoirManager):
+            manager.readings = {}
+            manager.updated_areas = set()
+        elif isinstance(manager, ElectricityManager):
+            manager.updated_time = None
+            manager.etag = manager.last_modified = None
+        else:
+            manager.watermarks = {type_: None for type_ in manager.watermarks}
+            manager.data = {area: [] for area in manager.data}
+
+    results = []
+    for name, manager in managers.items():
+        reset(manager)
+        payloads = manager.fetch()
+
+        def parse_payloads(manager=manager, payloads=payloads):
+            reset(manager)
+            manager.parse(payloads)
+
+        for step, func, setup in (
+            ("update_func", manager.update_func, functools.partial(reset, manager)),
+            ("update_database", manager.update_database, parse_payloads),
+        ):
+            result = measure(func, args.repeat, args.max_seconds, setup)
+            results.append({"name": f"{name}.{step}", "size": None, **result})
+            print_result(results[-1])
+    return results
+
+
+def load_rows(size):
+    from sqlalchemy import delete, insert
+    from api.database import session_maker_modify
+    from api.regions import get_regions
+    from api.rollup import rebuild_rollups
+    from api.models import (
+        Reservoir,
+        Electricity,
+        Earthquake,
+        LatestReservoir,
+        LatestElectricity,
+    )
+
+    areas = get_regions().reservoir_areas
+    earthquake_areas = get_regions().earthquake_areas
+    with session_maker_modify() as db:
+        for model in (Reservoir, Electricity, Earthquake):
+            db.execute(delete(model))
+            for rollup in model.rollups.values():
+                db.execute(delete(rollup))
+
+    def insert_batches(model, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == 10000:
+                with session_maker_modify() as db:
+                    db.execute(insert(model), batch)
+                batch = []
+        if batch:
+            with session_maker_modify() as db:
+                db.execute(insert(model), batch)
+
+    def electricity_row(i):
+        return {
+            "north_generate": 1000.0 + i % 500,
+            "north_usage": 1100.0 + i % 400,
+            "central_generate": 900.0 + i % 300,
+            "central_usage": 800.0 + i % 200,
+            "south_generate": 1200.0 + i % 100,
+            "south_usage": 1000.0 + i % 50,
+            "updated_time": END_TIME - datetime.timedelta(minutes=10 * i),
+        }
+
+    def reservoir_row(i):
+        return {
+            "area": areas[i % len(areas)],
+            "inflow": 10.0 + i % 7,
+            "outflow": 9.0 + i % 5,
+            "total_capacity": 30000.0,
+            "current_capacity": 15000.0 + i % 1000,
+            "percentage": (15000.0 + i % 1000) / 30000.0,
+            "updated_time": END_TIME - datetime.timedelta(hours=i // len(areas)),
+        }
+
+    insert_batches(Electricity, (electricity_row(i) for i in range(size)))
+    insert_batches(Reservoir, (reservoir_row(i) for i in range(size)))
+    insert_batches(
+        Earthquake,
+        (
+            {
+                "area": earthquake_areas[i % len(earthquake_areas)],
+                "source": "花蓮縣",
+                "number": i // len(earthquake_areas),
+                "pga": 0.5 + i % 30,
+                "pgv": (0.5 + i % 30) / 8.6561,
+                "observed_time": END_TIME
+                - datetime.timedelta(minutes=30 * (i // len(earthquake_areas))),
+            }
+            for i in range(size)
+        ),
+    )
+
+    # The fetcher keeps the rollups and the newest rows up to date as well
+    for model in (Reservoir, Electricity, Earthquake):
+        rebuild_rollups(session_maker_modify, model)
+    with session_maker_modify() as db:
+        db.merge(LatestElectricity(**electricity_row(0)))
+        for i in range(len(areas)):
+            db.merge(LatestReservoir(**reservoir_row(i)))
+
+
+def bench_views(client, size, args):
+    from apps.api.views import index_cache
+
+    # Row ids are reused after the tables are reloaded
+    index_cache["version"] = None
+
+    # Hourly reservoir rows of three areas span size * 20 minutes
+    start = (END_TIME - datetime.timedelta(minutes=20 * size)).strftime("%Y-%m-%d")
+    end = END_TIME.strftime("%Y-%m-%d")
+    span = f"start={start}&end={end}"
+    etag = client.get("/").headers["ETag"]
+
+    def get(url, headers=None):
+        response = client.get(url, headers=headers)
+        response.get_data()
+        response.close()
+
+    requests = {
+        "view.index": functools.partial(get, "/"),
+        "view.index_not_modified": functools.partial(get, "/", {"If-None-Match": etag}),
+        "view.electricity_range": functools.partial(get, f"/electricity?{span}"),
+        "view.electricity_bucket_1d": functools.partial(
+            get, f"/electricity?{span}&bucket=1d"
+        ),
+        "view.electricity_bucket_auto": functools.partial(
+            get, f"/electricity?{span}&bucket=auto"
+        ),
+        "view.reservoir_bucket_1d": functools.partial(
+            get, f"/reservoir?{span}&bucket=1d"
+        ),
+        "view.electricity_page_1000": functools.partial(
+            get, f"/electricity?{span}&limit=1000"
+        ),
+        "view.reservoir_range": functools.partial(get, f"/reservoir?{span}"),
+        "view.earthquake_range": functools.partial(get, f"/earthquake?{span}"),
+    }
+
+    results = []
+    for name, func in requests.items():
+        result = measure(func, args.repeat, args.max_seconds)
+        results.append({"name": name, "size": size, **result})
+        print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    size = "" if result["size"] is None else f"[{result['size']}]"
+    print(
+        f"{result['name'] + size:<40} {result['ops_per_sec']:>10.1f} ops/s "
+        f"p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+        f"peak {result['peak_memory_kb']:>10.1f} KiB"
+    )
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {
+            (result["name"], result["size"]): result
+            for result in json.load(f)["results"]
+        }
+
+    print(f"\nCompared with {baseline_file} (ops/s ratio, >1 is faster)")
+    for result in results:
+        old = baseline.get((result["name"], result["size"]))
+        if old is not None:
+            size = "" if result["size"] is None else f"[{result['size']}]"
+            print(
+                f"{result['name'] + size:<40} "
+                f"{result['ops_per_sec'] / old['ops_per_sec']:>6.2f}x"
+            )
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the managers and views against recorded payloads"
+    )
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=10.0,
+        help="stop repeating a benchmark after this long (at least 3 runs)",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="store to benchmark against, a temporary SQLite file by default",
+    )
+    parser.add_argument("--output", help="defaults to bench/results/<commit>.json")
+    parser.add_argument("--compare", help="result file of an earlier run")
+    args = parser.parse_args()
+
+    # Run from the repository root, where the managers expect their files
+    os.chdir(ROOT)
+    tmp_dir = tempfile.TemporaryDirectory()
+    os.environ["DATABASE_URL"] = args.database_url or (
+        f"sqlite:///{Path(tmp_dir.name, 'bench.sqlite')}"
+    )
+
+    from api.database import engine, init_db
+    from apps.app import create_app
+
+    init_db()
+    server, base_url = start_fixture_server()
+    client = create_app("testing").test_client()
+
+    results = bench_managers(base_url, args)
+    for size in args.sizes:
+        load_rows(size)
+        results += bench_views(client, size, args)
+    server.shutdown()
+
+    commit = get_commit()
+    output = Path(args.output or Path(ROOT, "bench", "results", f"{commit}.json"))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "created_time": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "database": engine.dialect.name,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"\nSaved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+from pathlib import Path
+import os
+import tempfile
+
+import pytest
+
+# Tests touching the database run against a SQLite file of their own, created
+# for every session, whatever DATABASE_URL says: the tests write rows at fixed
+# times and would collide with the rows of an earlier run
+database_dir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(database_dir.name, 'test.sqlite')}"
+
+
+@pytest.fixture(scope="session")
+def app():
+    from api.database import init_db
+    from apps.app import create_app
+
+    init_db()
+    return create_app("testing")
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
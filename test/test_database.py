@@ -0,0 +1,36 @@
+from sqlalchemy import select, text
+from sqlalchemy.orm import sessionmaker
+
+from api import database
+from api.models import Electricity
+
+
+def test_routing(monkeypatch, tmp_path):
+    write_engine = database.make_engine(f"sqlite:///{tmp_path}/write.db", "test-w")
+    read_engine = database.make_engine(f"sqlite:///{tmp_path}/read.db", "test-r")
+    monkeypatch.setattr(database, "write_engine", write_engine)
+    monkeypatch.setattr(database, "read_engines", [read_engine])
+    session = sessionmaker(class_=database.RoutingSession)()
+
+    with database.session_maker_readonly(session):
+        assert session.get_bind(clause=select(Electricity)) is read_engine
+        assert session.get_bind(clause=text("DELETE FROM electricity")) is read_engine
+    with database.session_maker_modify(session):
+        assert session.get_bind(clause=select(Electricity)) is write_engine
+    assert "write" not in session.info and "read_engine" not in session.info
+
+
+def test_pool_metrics(tmp_path):
+    from prometheus_client import REGISTRY
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {"engine": "test-pool"})
+
+    engine = database.make_engine(f"sqlite:///{tmp_path}/pool.db", "test-pool")
+    with engine.connect():
+        assert sample("db_pool_checked_out") == 1
+        with engine.connect():
+            assert sample("db_pool_checked_out") == 2
+    assert sample("db_pool_checked_out") == 0
+    assert sample("db_pool_checkout_seconds_count") == 2
+    assert sample("db_pool_size") == database.POOL_OPTIONS["pool_size"]
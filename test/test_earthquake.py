@@ -41,3 +41,219 @@ def test_earthquake_normal():
             earthquake_manager.data[key][:-1], earthquake_manager.data[key][1:]
         ):
             assert cur_time["observed_time"] >= prev_time["observed_time"]
+
+
+def test_earthquake_bulk_insert():
+    import datetime
+    from api.database import init_db, session_maker_modify, session_maker_readonly
+    from api.models import Earthquake
+
+    init_db()
+    earthquake_manager = EarthquakeManager(session_maker_modify, Earthquake)
+    observed_time = datetime.datetime(2100, 1, 1)
+    rows = [
+        {
+            "area": area,
+            "source": "花蓮縣",
+            "number": 100001,
+            "observed_time": observed_time,
+            "pga": 1.0,
+            "pgv": 0.1,
+        }
+        for area in ("新竹", "臺中", "臺南")
+    ]
+
+    earthquake_manager.rows = list(rows)
+    earthquake_manager.require_update_database = True
+    earthquake_manager.update_database()
+    earthquake_manager.rows = list(rows)
+    earthquake_manager.require_update_database = True
+    earthquake_manager.update_database()
+
+    with session_maker_readonly() as db:
+        assert (
+            db.query(Earthquake)
+            .filter(Earthquake.observed_time == observed_time)
+            .count()
+            == 3
+        )
+
+
+def test_earthquake_incremental():
+    import datetime
+    from api.database import init_db, session_maker_modify, session_maker_readonly
+    from api.models import Earthquake, FetchState
+
+    # Offline, with a window reaching back to the test data
+    class OfflineEarthquakeManager(EarthquakeManager):
+        large_url = small_url = "nowhere"
+        window = datetime.timedelta(days=365 * 100)
+
+    def earthquake(number, origin_time, magnitude=5.0):
+        return {
+            "EarthquakeNo": number,
+            "EarthquakeInfo": {
+                "OriginTime": origin_time,
+                "FocalDepth": 10.0,
+                "Epicenter": {
+                    "Location": "花蓮縣政府東南方",
+                    "EpicenterLatitude": 23.9,
+                    "EpicenterLongitude": 121.7,
+                },
+                "EarthquakeMagnitude": {"MagnitudeValue": magnitude},
+            },
+        }
+
+    def count():
+        with session_maker_readonly() as db:
+            return (
+                db.query(Earthquake)
+                .filter(Earthquake.observed_time.between(first_time, last_time))
+                .count()
+            )
+
+    init_db()
+    first = earthquake(95001, "1995-01-01 00:00:00")
+    second = earthquake(95002, "1995-01-02 00:00:00")
+    first_time = datetime.datetime(1995, 1, 1)
+    last_time = datetime.datetime(1995, 1, 2)
+    earthquake_manager = OfflineEarthquakeManager(
+        session_maker_modify, Earthquake, state_cls=FetchState
+    )
+
+    earthquake_manager.process({"l": [first], "s": []})
+    assert count() == 3
+    assert earthquake_manager.get_time_from("l") == "1995-01-01T00:00:00"
+
+    # Only the earthquake after the watermark is parsed and written
+    earthquake_manager.process({"l": [second, first], "s": None})
+    assert earthquake_manager.rows == []
+    assert count() == 6
+    assert [datum["number"] for datum in earthquake_manager.data["臺中"]] == [
+        95002,
+        95001,
+    ]
+
+    # A restarted fetcher resumes from the stored watermark and window
+    restarted = OfflineEarthquakeManager(
+        session_maker_modify, Earthquake, state_cls=FetchState
+    )
+    assert restarted.watermarks["l"] == (last_time, 95002)
+    assert [
+        datum for datum in restarted.data["臺中"] if datum["observed_time"] <= last_time
+    ] == earthquake_manager.data["臺中"]
+
+    # The feeds list the newest earthquakes first, all of them are new
+    earthquake_manager.process(
+        {
+            "l": None,
+            "s": [
+                earthquake(95004, "1995-01-01 18:00:00"),
+                earthquake(95003, "1995-01-01 12:00:00"),
+            ],
+        }
+    )
+    assert count() == 12
+    assert earthquake_manager.watermarks["s"] == (
+        datetime.datetime(1995, 1, 1, 18),
+        95004,
+    )
+
+    # Too weak to be stored anywhere, the watermark is stored all the same
+    earthquake_manager.process(
+        {"l": [earthquake(95005, "1995-01-02 06:00:00", magnitude=0.1)], "s": None}
+    )
+    assert earthquake_manager.rows == []
+    with session_maker_readonly() as db:
+        state = db.get(FetchState, "earthquake_l")
+        assert (state.observed_time, state.number) == (
+            datetime.datetime(1995, 1, 2, 6),
+            95005,
+        )
+
+    # Earthquakes past the window are evicted
+    earthquake_manager.updated_time = last_time + earthquake_manager.window
+    earthquake_manager.process({"l": [], "s": []})
+    assert [datum["number"] for datum in earthquake_manager.data["臺中"]] == [95002]
+
+
+def test_earthquake_matrix():
+    import random
+    from api.manager import (
+        compute_pga_pgv,
+        compute_pga_pgv_matrix,
+        geo_distance,
+        geo_distance_matrix,
+    )
+
+    rng = random.Random(0)
+    events = [
+        (
+            rng.uniform(21, 26),
+            rng.uniform(119, 123),
+            rng.uniform(1, 60),
+            rng.uniform(2, 7),
+        )
+        for _ in range(20)
+    ]
+    sites = [
+        (rng.uniform(21, 26), rng.uniform(119, 123), rng.uniform(0.5, 2))
+        for _ in range(7)
+    ]
+
+    distance = geo_distance_matrix([event[:2] for event in events], sites)
+    pga, pgv = compute_pga_pgv_matrix(
+        distance,
+        [event[2] for event in events],
+        [event[3] for event in events],
+        [site[2] for site in sites],
+    )
+    assert pga.shape == pgv.shape == (len(events), len(sites))
+
+    for i, event in enumerate(events):
+        for j, site in enumerate(sites):
+            expected_distance = geo_distance(site, event[:2])
+            expected_pga, expected_pgv = compute_pga_pgv(
+                expected_distance, event[2], event[3], site[2]
+            )
+            assert abs(distance[i, j] - expected_distance) < 1e-6
+            assert abs(pga[i, j] - expected_pga) <= 1e-9 * expected_pga
+            assert abs(pgv[i, j] - expected_pgv) <= 1e-9 * expected_pgv
+
+
+def test_earthquake_impacts():
+    import random
+    from api.manager import (
+        SiteGrid,
+        compute_impacts,
+        compute_pga_pgv,
+        cutoff_distance,
+        geo_distance,
+    )
+
+    # The PGA at the cutoff distance is the floor
+    pga, _ = compute_pga_pgv(cutoff_distance(5.0, 1.5, 0.8), 0, 5.0, 1.5)
+    assert abs(pga - 0.8) < 1e-9
+
+    rng = random.Random(0)
+    sites = [
+        (rng.uniform(21, 26), rng.uniform(119, 123), rng.uniform(0.5, 2))
+        for _ in range(300)
+    ]
+    events = [
+        (rng.uniform(21, 26), rng.uniform(119, 123), rng.uniform(1, 60), magnitude)
+        for magnitude in (2.0, 3.0, 4.0, 5.0, 6.5)
+    ]
+    impacts = compute_impacts(events, SiteGrid(sites), 0.8)
+
+    # Same sites as evaluating every pair
+    expected = set()
+    for i, event in enumerate(events):
+        for j, site in enumerate(sites):
+            pga, _ = compute_pga_pgv(
+                geo_distance(site, event[:2]), event[2], event[3], site[2]
+            )
+            if pga >= 0.8:
+                expected.add((i, j))
+    assert {(i, j) for i, j, _, _ in impacts} == expected
+    assert 0 < len(impacts) < len(events) * len(sites)
@@ -1,3 +1,5 @@
+import datetime
+
 from api import ElectricityManager
 
 
@@ -57,3 +59,138 @@ def test_electricity_normal():
             isinstance(electricity_manager.data["south_use"], float)
             and electricity_manager.data["south_use"] >= 0
         )
+
+
+def test_electricity_not_modified(tmp_path):
+    import functools
+    import http.server
+    import threading
+
+    (tmp_path / "gen.csv").write_text(
+        "2100-01-01 00:10,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0\n"
+        "2100-01-01 00:00,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0\n"
+    )
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(
+            http.server.SimpleHTTPRequestHandler, directory=str(tmp_path)
+        ),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class LocalElectricityManager(ElectricityManager):
+        gen_use_url = f"http://127.0.0.1:{server.server_address[1]}/gen.csv"
+
+    try:
+        electricity_manager = LocalElectricityManager()
+        assert electricity_manager.require_update_database
+        assert electricity_manager.data["south_use"] == 6.0
+        assert electricity_manager.updated_time == electricity_manager.format_time(
+            "2100-01-01 00:10"
+        )
+
+        # The file did not change, the server answers 304 and nothing is parsed
+        electricity_manager.update_func()
+        assert not electricity_manager.require_update_database
+        assert electricity_manager.data["south_use"] == 6.0
+
+        # Served as application/octet-stream, without a charset
+        (tmp_path / "gen.bin").write_bytes((tmp_path / "gen.csv").read_bytes())
+        LocalElectricityManager.gen_use_url = (
+            LocalElectricityManager.gen_use_url[: -len("gen.csv")] + "gen.bin"
+        )
+        assert LocalElectricityManager().data["south_use"] == 6.0
+    finally:
+        server.shutdown()
+
+
+def test_electricity_bulk_insert():
+    from api.database import init_db, session_maker_modify, session_maker_readonly
+    from api.models import Electricity, LatestElectricity
+
+    class OfflineElectricityManager(ElectricityManager):
+        gen_use_url = "nowhere"
+
+    init_db()
+    electricity_manager = OfflineElectricityManager(
+        session_maker_modify, Electricity, latest_cls=LatestElectricity
+    )
+    rows = [
+        "1990-01-01 00:10,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0",
+        "1990-01-01 00:00,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0",
+    ]
+
+    def ingest(rows):
+        electricity_manager.process(
+            {"gen_use": {"rows": rows, "etag": None, "last_modified": None}}
+        )
+
+    def count():
+        with session_maker_readonly() as db:
+            return (
+                db.query(Electricity)
+                .filter(
+                    Electricity.updated_time.between(
+                        datetime.datetime(1990, 1, 1), datetime.datetime(1990, 1, 2)
+                    )
+                )
+                .count()
+            )
+
+    ingest(rows)
+    assert count() == 2
+
+    # Only the new sample is written, the stored ones are skipped
+    ingest(["1990-01-01 00:20,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0"] + rows)
+    assert count() == 3
+    assert electricity_manager.data["updated_time"] == datetime.datetime(
+        1990, 1, 1, 0, 20
+    )
+    with session_maker_readonly() as db:
+        assert db.get(LatestElectricity, "electricity").updated_time == (
+            datetime.datetime(1990, 1, 1, 0, 20)
+        )
+
+    # Nothing newer, nothing is written
+    ingest(rows)
+    assert not electricity_manager.require_update_database
+    assert count() == 3
+
+
+def test_electricity_metrics():
+    from prometheus_client import REGISTRY
+
+    from api.database import init_db, session_maker_modify
+    from api.models import Electricity
+
+    class OfflineElectricityManager(ElectricityManager):
+        gen_use_url = "nowhere"
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, {"manager": "electricity", **labels})
+
+    init_db()
+    errors = sample("fetcher_errors_total", stage="fetch") or 0
+    fetches = sample("fetcher_upstream_seconds_count", source="gen_use") or 0
+    inserted = sample("fetcher_rows_total", result="inserted") or 0
+    skipped = sample("fetcher_rows_total", result="skipped") or 0
+
+    # The URL is invalid, the fetch is timed and counted as an error
+    electricity_manager = OfflineElectricityManager(session_maker_modify, Electricity)
+    assert sample("fetcher_errors_total", stage="fetch") == errors + 1
+    assert sample("fetcher_upstream_seconds_count", source="gen_use") == fetches + 1
+
+    rows = [
+        "1991-01-01 00:10,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0",
+        "1991-01-01 00:00,1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0",
+    ]
+    electricity_manager.process(
+        {"gen_use": {"rows": rows, "etag": None, "last_modified": None}}
+    )
+    electricity_manager.updated_time = None
+    electricity_manager.process(
+        {"gen_use": {"rows": rows, "etag": None, "last_modified": None}}
+    )
+    assert sample("fetcher_rows_total", result="inserted") == inserted + 2
+    assert sample("fetcher_rows_total", result="skipped") == skipped + 2
+    assert 0 <= sample("fetcher_seconds_since_last_update") < 60
@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+from api.database import init_db, session_maker_modify
+from api.leader import LeaderLease
+from api.models import Lease
+
+
+def test_leader_single_owner():
+    init_db()
+    first = LeaderLease(session_maker_modify, Lease, "test", 60, holder="first")
+    second = LeaderLease(session_maker_modify, Lease, "test", 60, holder="second")
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.acquire()
+    assert first.held and not second.held
+
+
+def test_leader_failover():
+    init_db()
+    first = LeaderLease(session_maker_modify, Lease, "failover", 60, holder="first")
+    second = LeaderLease(session_maker_modify, Lease, "failover", 60, holder="second")
+    assert first.acquire()
+
+    # The first replica stops renewing and its lease runs out
+    with session_maker_modify() as db:
+        db.get(Lease, "failover").expires_time = datetime.utcnow() - timedelta(
+            seconds=1
+        )
+    assert second.acquire()
+    assert not first.acquire()
+
+    second.release()
+    assert first.acquire()
@@ -0,0 +1,74 @@
+from sqlalchemy import inspect, text
+
+from api import database
+from api.migrate import migrate_schema, unique_keys
+
+
+def test_migrate_schema(tmp_path):
+    engine = database.make_engine(f"sqlite:///{tmp_path}/old.db", "test-migrate")
+    # Tables as created before the unique keys existed
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE earthquake (_id INTEGER PRIMARY KEY, area VARCHAR(20) "
+                "NOT NULL, source VARCHAR(20) NOT NULL, pga FLOAT NOT NULL, pgv FLOAT "
+                "NOT NULL, observed_time DATETIME NOT NULL)"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE electricity (_id INTEGER PRIMARY KEY, north_generate "
+                "FLOAT NOT NULL, north_usage FLOAT NOT NULL, central_generate FLOAT "
+                "NOT NULL, central_usage FLOAT NOT NULL, south_generate FLOAT NOT "
+                "NULL, south_usage FLOAT NOT NULL, updated_time DATETIME NOT NULL)"
+            )
+        )
+        for _ in range(2):
+            connection.execute(
+                text(
+                    "INSERT INTO electricity VALUES (NULL, 1.0, 1.0, 1.0, 1.0, 1.0, "
+                    "1.0, '1975-01-01 00:00:00')"
+                )
+            )
+        connection.execute(
+            text(
+                "CREATE TABLE reservoir (_id INTEGER PRIMARY KEY, area VARCHAR(30) "
+                "NOT NULL, inflow FLOAT NOT NULL, outflow FLOAT NOT NULL, "
+                "total_capacity FLOAT NOT NULL, current_capacity FLOAT NOT NULL, "
+                "percentage FLOAT NOT NULL, updated_time DATETIME NOT NULL)"
+            )
+        )
+        # A rewritten total, the later row holds the new figures
+        for percentage in (40.0, 50.0):
+            connection.execute(
+                text(
+                    "INSERT INTO reservoir VALUES (NULL, '新竹', 1.0, 1.0, 1.0, 1.0, "
+                    ":percentage, '1975-01-01 00:00:00')"
+                ),
+                {"percentage": percentage},
+            )
+        for area in ("新竹", "新竹", "臺南"):
+            connection.execute(
+                text(
+                    "INSERT INTO earthquake (area, source, pga, pgv, observed_time) "
+                    "VALUES (:area, '花蓮縣', 1.0, 0.1, '1975-01-01 00:00:00')"
+                ),
+                {"area": area},
+            )
+
+    migrate_schema(engine)
+    # Applied steps are skipped
+    migrate_schema(engine)
+
+    inspector = inspect(engine)
+    assert "uq_earthquake_event" in unique_keys(inspector, "earthquake")
+    assert "uq_electricity_updated_time" in unique_keys(inspector, "electricity")
+    assert "uq_reservoir_area_time" in unique_keys(inspector, "reservoir")
+    with engine.connect() as connection:
+        assert connection.execute(
+            text("SELECT _id, area, number FROM earthquake ORDER BY _id")
+        ).all() == [(2, "新竹", 0), (3, "臺南", 0)]
+        assert connection.execute(text("SELECT _id FROM electricity")).all() == [(2,)]
+        assert connection.execute(
+            text("SELECT _id, percentage FROM reservoir")
+        ).all() == [(2, 50.0)]
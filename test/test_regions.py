@@ -0,0 +1,34 @@
+from api.regions import Regions, get_regions
+
+
+def test_regions_from_file():
+    regions = get_regions()
+    assert regions is get_regions()
+    assert regions.areas[:3] == regions.earthquake_areas == ["新竹", "臺中", "臺南"]
+    assert regions.reservoir_areas == regions.areas
+    assert len(regions.areas) == 18
+    # Assigned by id_to_county, found in 桃園市 by id_to_town_name
+    assert "10201" in regions.area_to_ids["新竹"]
+    assert regions.id_to_area["10204"] == "基隆"
+    assert len(regions.id_to_area) == len(regions.id_to_name)
+    assert all(
+        regions.id_to_area[id_] == area
+        for area, ids in regions.area_to_ids.items()
+        for id_ in ids
+    )
+
+
+def test_regions_added_county():
+    regions = Regions(
+        {
+            "id_to_name": {"1": "A", "2": "B", "3": "C"},
+            "id_to_town_name": {"1": "甲縣某鄉", "2": "乙巿某區", "4": "丁城市某區"},
+            "id_to_county": {"1": "甲", "2": "乙", "3": "甲"},
+            "county_pos": {"丙": [23.0, 120.0, 1.0], "甲": [24.0, 121.0, 1.5]},
+        }
+    )
+    assert regions.areas == ["丙", "甲", "乙", "丁城"]
+    assert regions.reservoir_areas == ["甲", "乙", "丁城"]
+    assert regions.earthquake_areas == ["丙", "甲"]
+    assert regions.area_to_ids == {"甲": ["1", "3"], "乙": ["2"], "丁城": ["4"]}
+    assert regions.area_pos["甲"] == (24.0, 121.0, 1.5)
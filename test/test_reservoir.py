@@ -60,3 +60,118 @@ def test_reservoir_normal():
             )
             < 1e-5
         )
+
+
+def test_reservoir_readings():
+    import datetime
+    from api.database import init_db, session_maker_modify, session_maker_readonly
+    from api.models import Reservoir, ReservoirReading
+
+    class OfflineReservoirManager(ReservoirManager):
+        reservoir_overall_url = reservoir_detail_url = "nowhere"
+
+    def overall(id_, capacity):
+        return {
+            "ReservoirIdentifier": id_,
+            "RecordTime": "1985-01-01T00:00:00",
+            "EffectiveCapacity": capacity,
+            "InflowVolume": "1.0",
+            "OutflowTotal": "2.0",
+        }
+
+    def details(id_, hour, storage):
+        return {
+            "ReservoirIdentifier": id_,
+            "ObservationTime": f"1985-01-01T{hour:02}:00:00",
+            "EffectiveWaterStorageCapacity": storage,
+        }
+
+    def count(model, time_column):
+        with session_maker_readonly() as db:
+            return (
+                db.query(model)
+                .filter(
+                    time_column.between(
+                        datetime.datetime(1985, 1, 1), datetime.datetime(1985, 1, 2)
+                    )
+                )
+                .count()
+            )
+
+    init_db()
+    reservoir_manager = OfflineReservoirManager(
+        session_maker_modify, Reservoir, reading_cls=ReservoirReading
+    )
+    payloads = {
+        "overall": [
+            overall("10201", "200"),
+            overall("10401", "100"),
+            overall("20101", "50"),
+        ],
+        "details": [
+            details("10201", 0, "100"),
+            details("10201", 1, "120"),
+            details("10401", 0, "50"),
+        ],
+    }
+    reservoir_manager.process(payloads)
+    assert count(ReservoirReading, ReservoirReading.observed_time) == 3
+    assert count(Reservoir, Reservoir.updated_time) == 1
+
+    # The county sums the newest reading of each of its reservoirs
+    data = reservoir_manager.data["新竹"]
+    assert data["current_capacity"] == 170.0 and data["total_capacity"] == 300.0
+    assert abs(data["percentage"] - 170.0 / 300.0) < 1e-9
+    assert data["updated_time"] == datetime.datetime(1985, 1, 1, 1)
+    # No observation of its reservoir yet
+    assert reservoir_manager.data["臺中"]["updated_time"] == "N/A"
+
+    # Only the new observation is written
+    payloads["details"].append(details("10401", 2, "60"))
+    reservoir_manager.process(payloads)
+    assert count(ReservoirReading, ReservoirReading.observed_time) == 4
+    assert count(Reservoir, Reservoir.updated_time) == 2
+    assert reservoir_manager.data["新竹"]["current_capacity"] == 180.0
+
+    def total_id():
+        with session_maker_readonly() as db:
+            return (
+                db.query(Reservoir._id)
+                .filter_by(area="新竹", updated_time=datetime.datetime(1985, 1, 1, 2))
+                .scalar()
+            )
+
+    # Observed at the time of the stored total, the total is replaced by a
+    # new row, so the versions of the views see the change
+    previous_id = total_id()
+    payloads["details"].append(details("10201", 2, "140"))
+    reservoir_manager.process(payloads)
+    assert total_id() > previous_id
+    assert count(ReservoirReading, ReservoirReading.observed_time) == 5
+    assert count(Reservoir, Reservoir.updated_time) == 2
+    with session_maker_readonly() as db:
+        total = (
+            db.query(Reservoir)
+            .filter_by(area="新竹", updated_time=datetime.datetime(1985, 1, 1, 2))
+            .one()
+        )
+        assert total.current_capacity == 200.0
+
+    # Nothing new, nothing is written
+    reservoir_manager.process(payloads)
+    assert not reservoir_manager.require_update_database
+    assert count(Reservoir, Reservoir.updated_time) == 2
+
+    # A restarted fetcher resumes from the stored readings and writes nothing
+    restarted_manager = OfflineReservoirManager(
+        session_maker_modify, Reservoir, reading_cls=ReservoirReading
+    )
+    assert restarted_manager.data["新竹"] == reservoir_manager.data["新竹"]
+    restarted_manager.process(payloads)
+    assert not restarted_manager.require_update_database
+
+    # Without them, the readings are skipped and so are the county totals
+    restarted_manager.readings = {}
+    restarted_manager.process(payloads)
+    assert count(ReservoirReading, ReservoirReading.observed_time) == 5
+    assert count(Reservoir, Reservoir.updated_time) == 2
@@ -0,0 +1,124 @@
+import datetime
+
+from api import retention
+
+
+def test_months():
+    month = datetime.datetime(2023, 11, 15, 8, 30)
+    assert retention.month_start(month) == datetime.datetime(2023, 11, 1)
+    assert retention.add_months(datetime.datetime(2023, 1, 1), -1) == (
+        datetime.datetime(2022, 12, 1)
+    )
+    assert [
+        f"{month:%Y-%m}"
+        for month in retention.month_range(month, datetime.datetime(2024, 2, 1))
+    ] == ["2023-11", "2023-12", "2024-01", "2024-02"]
+    assert retention.partition_definitions([datetime.datetime(2023, 12, 1)]) == (
+        "PARTITION p202312 VALUES LESS THAN (TO_DAYS('2024-01-01')), "
+        "PARTITION pfuture VALUES LESS THAN MAXVALUE"
+    )
+    # TO_DAYS('1970-01-01') in information_schema.PARTITIONS
+    assert retention.parse_partition_bound("719528") == datetime.datetime(1970, 1, 1)
+    assert retention.parse_partition_bound("MAXVALUE") is None
+
+
+def test_archive_expired_months(client, tmp_path, monkeypatch):
+    from api.database import engine, session_maker_modify, session_maker_readonly
+    from api.models import Earthquake
+
+    monkeypatch.setattr(retention, "ARCHIVE_DIR", tmp_path)
+    # Several row groups and batches per month
+    monkeypatch.setattr(retention, "ARCHIVE_ROW_GROUP_SIZE", 2)
+    monkeypatch.setattr(retention, "ARCHIVE_BATCH_SIZE", 1)
+    with session_maker_modify() as db:
+        for day in (1, 2):
+            for area in ("新竹", "臺南"):
+                db.add(
+                    Earthquake(
+                        area, "花蓮縣", day, 1.0, 0.1, datetime.datetime(1970, 1, day)
+                    )
+                )
+
+    # Keeps 24 months, January 1970 is moved out of the database
+    retention.maintain_storage(engine, now=datetime.datetime(1972, 6, 1))
+    assert (tmp_path / "earthquake" / "1970-01.parquet").exists()
+    with session_maker_readonly() as db:
+        assert (
+            db.query(Earthquake)
+            .filter(Earthquake.observed_time < datetime.datetime(1971, 1, 1))
+            .count()
+            == 0
+        )
+
+    data = client.get("/earthquake?start=1970-01-01&end=1970-01-31").get_json()
+    assert [datum["observed_time"] for datum in data["新竹"]] == [
+        "1970-01-01 00:00:00",
+        "1970-01-02 00:00:00",
+    ]
+    assert len(data["臺南"]) == 2
+
+    url = "/earthquake?start=1970-01-01&end=1970-01-31&limit=3"
+    response = client.get(url)
+    assert sum(len(rows) for rows in response.get_json().values()) == 3
+    response = client.get(url + "&cursor=" + response.headers["X-Next-Cursor"])
+    assert sum(len(rows) for rows in response.get_json().values()) == 1
+
+    # The range, the match and the cursor are applied by the Parquet scan
+    rows = retention.read_archive(
+        "earthquake",
+        ("_id", "area", "observed_time"),
+        "observed_time",
+        datetime.datetime(1970, 1, 1),
+        datetime.datetime(1970, 1, 31),
+        match={"area": "臺南"},
+    )
+    rows = list(rows)
+    assert [row["observed_time"].day for row in rows] == [1, 2]
+    assert {row["area"] for row in rows} == {"臺南"}
+    after = (rows[0]["observed_time"], rows[0]["_id"])
+    assert [
+        row["_id"]
+        for row in retention.read_archive(
+            "earthquake",
+            ("_id",),
+            "observed_time",
+            datetime.datetime(1970, 1, 1),
+            datetime.datetime(1970, 1, 31),
+            match={"area": "臺南"},
+            after=after,
+        )
+    ] == [rows[1]["_id"]]
+    assert (
+        retention.read_archive(
+            "earthquake",
+            ("_id",),
+            "observed_time",
+            datetime.datetime(1971, 1, 1),
+            datetime.datetime(1971, 1, 31),
+        )
+        is None
+    )
+    # Grouped ranges stream one area after the other
+    rows = retention.read_archive_groups(
+        "earthquake",
+        ("area", "observed_time"),
+        "observed_time",
+        "area",
+        datetime.datetime(1970, 1, 1),
+        datetime.datetime(1970, 1, 31),
+    )
+    assert [(row["area"], row["observed_time"].day) for row in rows] == sorted(
+        (area, day) for area in ("新竹", "臺南") for day in (1, 2)
+    )
+
+    # A late row of an archived month is added to its archive
+    with session_maker_modify() as db:
+        db.add(Earthquake("新竹", "花蓮縣", 3, 1.0, 0.1, datetime.datetime(1970, 1, 3)))
+    retention.maintain_storage(engine, now=datetime.datetime(1972, 6, 1))
+    data = client.get("/earthquake?start=1970-01-01&end=1970-01-31").get_json()
+    assert [datum["observed_time"][:10] for datum in data["新竹"]] == [
+        "1970-01-01",
+        "1970-01-02",
+        "1970-01-03",
+    ]
+    assert len(data["臺南"]) == 2
@@ -0,0 +1,47 @@
+import datetime
+
+from sqlalchemy import delete, select
+
+from api.database import init_db, session_maker_modify, session_maker_readonly
+from api.models import Earthquake, EarthquakeDaily, EarthquakeHourly
+from api.rollup import rebuild_rollups, update_rollups
+
+
+def test_earthquake_rollups():
+    init_db()
+    start_time = datetime.datetime(1980, 1, 1)
+
+    def add_earthquake(area, minutes, pga):
+        observed_time = start_time + datetime.timedelta(minutes=minutes)
+        with session_maker_modify() as db:
+            db.add(Earthquake(area, "花蓮縣", minutes, pga, pga / 10, observed_time))
+            update_rollups(db, Earthquake, [observed_time])
+
+    def read(rollup):
+        with session_maker_readonly() as db:
+            return [
+                (row.area, row.observed_time.hour, row.count, row.pga_max)
+                for row in db.scalars(
+                    select(rollup)
+                    .where(rollup.observed_time < datetime.datetime(1980, 1, 2))
+                    .order_by(rollup.area, rollup.observed_time)
+                )
+            ]
+
+    add_earthquake("新竹", 10, 2.0)
+    add_earthquake("新竹", 20, 5.0)
+    add_earthquake("新竹", 70, 1.0)
+    add_earthquake("臺南", 30, 3.0)
+
+    hourly = [("新竹", 0, 2, 5.0), ("新竹", 1, 1, 1.0), ("臺南", 0, 1, 3.0)]
+    daily = [("新竹", 0, 3, 5.0), ("臺南", 0, 1, 3.0)]
+    assert read(EarthquakeHourly) == hourly
+    assert read(EarthquakeDaily) == daily
+
+    # Rebuilding from the raw rows gives the same buckets
+    with session_maker_modify() as db:
+        db.execute(delete(EarthquakeHourly))
+        db.execute(delete(EarthquakeDaily))
+    rebuild_rollups(session_maker_modify, Earthquake)
+    assert read(EarthquakeHourly) == hourly
+    assert read(EarthquakeDaily) == daily
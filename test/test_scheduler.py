@@ -0,0 +1,41 @@
+from api.scheduler import PollSchedule
+
+
+def test_schedule_regular_grid():
+    schedule = PollSchedule(600, 60, 1800, jitter=0)
+
+    # Without publish times the deadlines stay on a grid, however long a poll
+    assert schedule.record(0) == 600
+    assert schedule.record(650) == 1200
+    assert schedule.record(2500) == 3000
+
+
+def test_schedule_follows_publish_times():
+    schedule = PollSchedule(600, 60, 1800, jitter=0)
+    schedule.record(10, published_time=0)
+    schedule.record(630, published_time=600)
+    # Published every 600 s and seen 30 s later at best
+    assert schedule.record(1230, published_time=1200) == 1830
+
+    # Nothing new after the expected publish, polls slow down
+    assert schedule.record(1830) == 1890
+    assert schedule.record(1890) == 2010
+    assert schedule.record(2010) == 2250
+
+
+def test_schedule_backoff():
+    schedule = PollSchedule(600, 60, 1800, jitter=0)
+    assert schedule.record(0, failed=True) == 60
+    assert schedule.record(60, failed=True) == 180
+    for now in range(10):
+        deadline = schedule.record(now, failed=True)
+    assert deadline == 9 + 1800
+
+    # Back to the grid once the upstream answers again
+    assert schedule.record(2000) == 2409
+
+
+def test_schedule_jitter():
+    schedule = PollSchedule(600, 60, 1800, jitter=0.1)
+    for now in range(0, 6000, 600):
+        assert 600 <= schedule.record(now) - now <= 660
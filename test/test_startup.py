@@ -0,0 +1,34 @@
+import subprocess
+import sys
+
+from api.startup import parse_importtime
+
+
+def test_web_skips_manager_stack():
+    # A fresh interpreter, the test session has imported the managers already
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, apps.wsgi; "
+            "print(' '.join(m for m in ('api.manager', 'numpy', 'requests') "
+            "if m in sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_parse_importtime():
+    modules = parse_importtime(
+        [
+            "import time: self [us] | cumulative | imported package",
+            "import time:        10 |         10 |   json.decoder",
+            "import time:         5 |         15 | json",
+        ]
+    )
+    assert [module["name"] for module in modules] == ["json.decoder", "json"]
+    assert [module["depth"] for module in modules] == [1, 0]
+    assert modules[1]["cumulative_us"] == 15
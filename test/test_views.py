@@ -0,0 +1,281 @@
+import datetime
+import gzip
+import json
+
+from api.database import session_maker_modify
+from api.models import Electricity, LatestElectricity, Reservoir
+from api.rollup import update_rollups
+from api.regions import get_regions
+
+
+def add_electricity(updated_time, north_generate=1.0):
+    # Written like the fetcher does, history, rollups and latest row together
+    row = dict(
+        north_generate=north_generate,
+        north_usage=2.0,
+        central_generate=3.0,
+        central_usage=4.0,
+        south_generate=5.0,
+        south_usage=6.0,
+        updated_time=updated_time,
+    )
+    with session_maker_modify() as db:
+        db.add(Electricity(**row))
+        update_rollups(db, Electricity, [updated_time])
+        db.merge(LatestElectricity(**row))
+
+
+def test_index_cache(client):
+    from apps.api.views import index_cache_requests
+
+    def count(result):
+        return index_cache_requests.labels(result)._value.get()
+
+    first = client.get("/")
+    hits, misses = count("hit"), count("miss")
+    assert client.get("/").data == first.data
+    assert count("hit") == hits + 1 and count("miss") == misses
+
+    add_electricity(datetime.datetime(2100, 1, 1))
+    response = client.get("/")
+    assert count("miss") == misses + 1
+    assert response.get_json()["Electricity"]["updated_time"] == "2100-01-01 00:00:00"
+
+
+def test_range_stream(client):
+    for minute in range(0, 30, 10):
+        add_electricity(datetime.datetime(2100, 2, 1, 0, minute))
+
+    response = client.get("/electricity?start=2100-02-01&end=2100-02-01")
+    assert response.is_streamed
+    data = response.get_json()
+    assert [datum["updated_time"] for datum in data] == [
+        "2100-02-01 00:00:00",
+        "2100-02-01 00:10:00",
+        "2100-02-01 00:20:00",
+    ]
+    assert data[0]["south_usage"] == 6.0
+
+    data = client.get("/reservoir?start=2100-02-01&end=2100-02-01").get_json()
+    assert data == {area: [] for area in get_regions().reservoir_areas}
+
+
+def test_range_bucket(client):
+    for minute in range(0, 120, 10):
+        add_electricity(
+            datetime.datetime(2100, 3, 1) + datetime.timedelta(minutes=minute),
+            north_generate=float(minute),
+        )
+
+    url = "/electricity?start=2100-03-01&end=2100-03-01&bucket=1h"
+    data = client.get(url).get_json()
+    assert [datum["updated_time"] for datum in data] == [
+        "2100-03-01 00:00:00",
+        "2100-03-01 01:00:00",
+    ]
+    assert [datum["north_generate"] for datum in data] == [25.0, 85.0]
+    assert [datum["count"] for datum in data] == [6, 6]
+
+    data = client.get(url + "&agg=last").get_json()
+    assert [datum["north_generate"] for datum in data] == [50.0, 110.0]
+
+    data = client.get(url.replace("1h", "1d") + "&agg=max").get_json()
+    assert len(data) == 1 and data[0]["north_generate"] == 110.0
+
+    data = client.get(url.replace("1h", "auto")).get_json()
+    assert [datum["count"] for datum in data] == [6, 6]
+
+    assert client.get(url + "&agg=median").status_code == 400
+
+
+def test_range_page(client):
+    for minute in range(0, 50, 10):
+        add_electricity(datetime.datetime(2100, 4, 1, 0, minute))
+
+    url = "/electricity?start=2100-04-01&end=2100-04-01&limit=2"
+    times = []
+    response = client.get(url)
+    while True:
+        times += [datum["updated_time"] for datum in response.get_json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        assert 'rel="next"' in response.headers["Link"]
+        response = client.get(url + "&cursor=" + response.headers["X-Next-Cursor"])
+
+    assert times == [f"2100-04-01 00:{minute:02d}:00" for minute in range(0, 50, 10)]
+    assert client.get(url + "&cursor=broken").status_code == 400
+    assert client.get(url + "&bucket=1h").status_code == 400
+
+
+def test_conditional_get(client):
+    add_electricity(datetime.datetime(2100, 5, 1))
+    url = "/electricity?start=2100-05-01&end=2100-05-01"
+
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert (
+        client.get(
+            url, headers={"If-Modified-Since": response.headers["Last-Modified"]}
+        ).status_code
+        == 304
+    )
+
+    response = client.get("/")
+    assert (
+        client.get("/", headers={"If-None-Match": response.headers["ETag"]}).status_code
+        == 304
+    )
+
+    add_electricity(datetime.datetime(2100, 5, 1, 0, 10))
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(response.data))) == 2
+
+    # A row replaced at the same time changes the ETag of its range
+    reservoir_url = "/reservoir?start=2100-05-02&end=2100-05-02"
+    row = dict(
+        area="新竹",
+        inflow=1.0,
+        outflow=1.0,
+        total_capacity=100.0,
+        current_capacity=50.0,
+        percentage=0.5,
+        updated_time=datetime.datetime(2100, 5, 2),
+    )
+    with session_maker_modify() as db:
+        db.add(Reservoir(**row))
+    reservoir_etag = client.get(reservoir_url).headers["ETag"]
+    with session_maker_modify() as db:
+        db.query(Reservoir).filter_by(updated_time=row["updated_time"]).delete()
+        db.add(Reservoir(**{**row, "current_capacity": 60.0}))
+    reservoir_response = client.get(
+        reservoir_url, headers={"If-None-Match": reservoir_etag}
+    )
+    assert reservoir_response.status_code == 200
+    assert reservoir_response.get_json()["新竹"][0]["current_capacity"] == 60.0
+
+    # Each encoding has a validator of its own, and a 304 varies like the body
+    gzip_etag = response.headers["ETag"]
+    assert gzip_etag != client.get(url).headers["ETag"]
+    response = client.get(
+        url, headers={"If-None-Match": gzip_etag, "Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 304
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert client.get(url, headers={"If-None-Match": gzip_etag}).status_code == 200
+
+    # The index changes when earthquakes leave the window, only its ETag counts
+    response = client.get("/")
+    assert "Last-Modified" not in response.headers
+    assert (
+        client.get(
+            "/", headers={"If-Modified-Since": "Fri, 01 Jan 2200 00:00:00 GMT"}
+        ).status_code
+        == 200
+    )
+
+
+def test_reservoir_readings(client):
+    from api.models import ReservoirReading
+
+    with session_maker_modify() as db:
+        for reservoir_id, hour in (("10201", 0), ("10201", 1), ("10401", 0)):
+            db.add(
+                ReservoirReading(
+                    reservoir_id=reservoir_id,
+                    inflow=1.0,
+                    outflow=2.0,
+                    total_capacity=200.0,
+                    current_capacity=100.0 + hour,
+                    percentage=(100.0 + hour) / 200.0,
+                    observed_time=datetime.datetime(2150, 1, 1, hour),
+                )
+            )
+
+    data = client.get("/reservoir/10201?start=2150-01-01&end=2150-01-01").get_json()
+    assert [datum["current_capacity"] for datum in data] == [100.0, 101.0]
+    assert data[1]["observed_time"] == "2150-01-01 01:00:00"
+
+    data = client.get("/reservoir/10401?start=2150-01-01&end=2150-01-01&limit=1")
+    assert len(data.get_json()) == 1 and "X-Next-Cursor" not in data.headers
+
+
+def test_stream_events(client, monkeypatch):
+    from api.models import Earthquake
+    from apps.api import stream
+    from apps.api.stream import ChangeDetector, parse_version, stream_events
+
+    detector = ChangeDetector()
+    detector.poll()
+    events = stream_events(detector, max_age=60)
+    assert next(events).startswith("retry: ")
+    assert detector.subscribers == 1
+
+    with session_maker_modify() as db:
+        db.add(
+            Earthquake(
+                area="臺中",
+                source="花蓮縣",
+                number=200001,
+                pga=12.5,
+                pgv=1.4,
+                observed_time=datetime.datetime(2200, 1, 1),
+            )
+        )
+    # One query for every client, the clients are woken up with the new rows
+    detector.poll()
+    event_id, name, data = next(events).strip().splitlines()
+    assert name == "event: earthquake"
+    assert json.loads(data[len("data: ") :]) == [
+        {
+            "area": "臺中",
+            "source": "花蓮縣",
+            "number": 200001,
+            "pga": 12.5,
+            "pgv": 1.4,
+            "observed_time": "2200-01-01 00:00:00",
+        }
+    ]
+
+    # A client resuming from the previous event id gets it again, one
+    # resuming from this one does not
+    version = parse_version(event_id[len("id: ") :])
+    resumed = stream_events(detector, (*version[:2], version[2] - 1))
+    next(resumed)
+    assert next(resumed).startswith(event_id)
+    assert detector.newer(version) == []
+
+    # A burst is sent in several events, each id only covers its own rows
+    monkeypatch.setattr(stream, "STREAM_EARTHQUAKE_LIMIT", 1)
+    with session_maker_modify() as db:
+        for number in (200002, 200003):
+            db.add(
+                Earthquake(
+                    area="臺中",
+                    source="花蓮縣",
+                    number=number,
+                    pga=12.5,
+                    pgv=1.4,
+                    observed_time=datetime.datetime(2200, 1, 2),
+                )
+            )
+    detector.poll()
+    burst = [next(events).strip().splitlines() for _ in range(2)]
+    assert [json.loads(data[len("data: ") :])[0]["number"] for *_, data in burst] == [
+        200002,
+        200003,
+    ]
+    versions = [parse_version(event_id[len("id: ") :]) for event_id, *_ in burst]
+    assert versions[0][2] == version[2] + 1
+    assert versions[1] == detector.version
+
+    events.close()
+    resumed.close()
+    assert detector.subscribers == 0
+    assert parse_version("invalid") is None
+
+    # Served by the stream service only, never by the threads of the API
+    assert client.get("/stream").status_code == 404